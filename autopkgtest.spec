@@ -34,6 +34,7 @@ make all
 %{_bindir}/autopkgtest-build-podman
 %{_bindir}/autopkgtest-build-qemu
 %{_bindir}/autopkgtest-buildvm-ubuntu-cloud
+%{_bindir}/autopkgtest-validate
 %{_bindir}/autopkgtest-virt-chroot
 %{_bindir}/autopkgtest-virt-docker
 %{_bindir}/autopkgtest-virt-lxc
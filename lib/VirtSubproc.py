@@ -31,10 +31,14 @@ import signal
 import subprocess
 import traceback
 import errno
+import fcntl
 import time
+import re
+import select
 import socket
 import shutil
 import shlex
+import threading
 from typing import (List, Optional, Union, Tuple)
 
 import adtlog
@@ -49,12 +53,20 @@ progname = "<VirtSubproc>"
 devnull_read = open('/dev/null', 'rb')
 caller = __main__
 copy_timeout = int(os.getenv('AUTOPKGTEST_VIRT_COPY_TIMEOUT', '300'))
+# compression of directory copies: auto, none, zstd, or lz4
+copy_compression = os.getenv('AUTOPKGTEST_VIRT_COPY_COMPRESSION', 'auto')
+# number of parallel tar streams for copying large directories
+copy_streams = int(os.getenv('AUTOPKGTEST_VIRT_COPY_STREAMS', '1'))
+# only directories with at least this much file data get split into streams
+copy_split_size = 64 * 1048576
 
 downtmp_open = None  # downtmp after opening testbed
 downtmp = None  # current downtmp (None after close)
 auxverb = None  # prefix to run command argv in testbed
 cleaning = False
 in_mainloop = False
+stdin_buffer = b''  # data read from the caller but not yet processed
+copy_compressors = None  # type: Optional[List[str]]
 
 
 class Quit(RuntimeError):
@@ -111,7 +123,8 @@ def cmdnumargs(c, ce, nargs=0, noptargs=0):
 
 def cmd_capabilities(c, ce):
     cmdnumargs(c, ce)
-    return caller.hook_capabilities()
+    # batch is implemented here, for all servers
+    return list(caller.hook_capabilities()) + ['batch']
 
 
 def cmd_quit(c, ce):
@@ -291,59 +304,135 @@ def get_unix_socket(path):
     return s
 
 
-def matches_expectation(
-    haystack: bytes,
-    needle: Union[None, bytes, str, Tuple[Union[bytes, str]]],
-) -> bool:
-    if needle is None:
-        return True
-    elif isinstance(needle, tuple):
-        for n in needle:
-            if matches_expectation(haystack, n):
-                return True
+# how much console output expect() keeps around for matching and returning
+EXPECT_WINDOW = 65536
+
+
+class Expectation:
+    '''Incremental matcher for one or more strings in a byte stream
+
+    All needles are compiled into a single regular expression, and only the
+    part of the stream that has not been scanned yet (plus enough overlap for
+    a needle spanning two blocks) is searched on each feed(). At most
+    window_size bytes of the stream are retained, so that waiting on a chatty
+    console stays linear in the amount of output.
+    '''
+
+    def __init__(
+        self,
+        search: Union[None, bytes, str, Tuple[Union[bytes, str]]],
+        window_size: int = EXPECT_WINDOW,
+    ) -> None:
+        if search is None:
+            needles = []        # type: List[bytes]
+        elif isinstance(search, tuple):
+            needles = [n.encode('utf-8') if isinstance(n, str) else n
+                       for n in search]
+        elif isinstance(search, str):
+            needles = [search.encode('utf-8')]
         else:
-            return False
-    elif isinstance(needle, bytes):
-        return needle in haystack
-    elif isinstance(needle, str):
-        return needle.encode('utf-8') in haystack
-    else:
-        raise TypeError(repr(needle))
+            needles = [search]
+        for n in needles:
+            if not isinstance(n, bytes):
+                raise TypeError(repr(search))
 
+        if needles:
+            self.regex = re.compile(b'|'.join(map(re.escape, needles)))
+        else:
+            self.regex = None
+        self.overlap = max([len(n) for n in needles] + [1]) - 1
+        self.window_size = max(window_size, self.overlap + 1)
+        self.window = bytearray()
+        # offset into window before which no new match can start
+        self.scanned = 0
+        self.matched = None     # type: Optional[bytes]
+
+    def feed(self, block: bytes) -> bool:
+        '''Add block to the stream; return True if a needle was found'''
+
+        self.window += block
+        if self.regex is None:
+            # any data matches
+            self.matched = b''
+            return bool(block)
+
+        m = self.regex.search(self.window, max(0, self.scanned - self.overlap))
+        if m:
+            self.matched = m.group(0)
+            return True
 
-def expect(
+        self.scanned = len(self.window)
+        if len(self.window) > self.window_size:
+            drop = len(self.window) - self.window_size
+            del self.window[:drop]
+            self.scanned -= drop
+        return False
+
+
+def expect_match(
     sock: socket.socket,
     search: Union[None, bytes, str, Tuple[Union[bytes, str]]],
     timeout_sec: int,
     description: Optional[str] = None,
     echo: bool = False,
-):
+) -> Tuple[Optional[bytes], bytes]:
+    '''Wait until one of the search strings arrives on sock
+
+    search is a bytes or str, or a tuple of them to wait for any of them, or
+    None to wait for any data at all.
+
+    If it does not arrive within timeout_sec, bomb() if a description is
+    given, otherwise raise a Timeout exception.
+
+    Return (matched needle, received data). Older data is discarded as it
+    arrives, so the received data is only the last EXPECT_WINDOW bytes plus
+    the final block.
+    '''
     adtlog.debug('expect: %r' % (search,))
     what = repr(description or search or 'data')
-    out = b''
-    with timeout(timeout_sec,
-                 description and ('timed out waiting for %s' % what) or None):
-        while True:
-            block = sock.recv(4096)
-            if not block:
-                time.sleep(0.1)
+    expectation = Expectation(search)
+    poller = select.poll()
+    poller.register(sock, select.POLLIN)
+    deadline = time.monotonic() + timeout_sec
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining > 0 and poller.poll(remaining * 1000):
+            block = sock.recv(EXPECT_WINDOW)
+            if block:
+                if echo:
+                    sys.stderr.buffer.write(block)
+                    sys.stderr.buffer.flush()
+                if expectation.feed(block):
+                    adtlog.debug('expect: found "%s"' % what)
+                    return (expectation.matched, bytes(expectation.window))
                 continue
-            if echo:
-                sys.stderr.buffer.write(block)
-            out += block
+            adtlog.debug('expect: end of file while waiting for %s' % what)
 
-            if matches_expectation(out, search):
-                adtlog.debug('expect: found "%s"' % what)
-                break
+        # timed out, or EOF which means that nothing will arrive any more
+        if description:
+            bomb('timed out waiting for %s' % what)
+        raise Timeout(timeout_sec)
 
-    return out
+
+def expect(
+    sock: socket.socket,
+    search: Union[None, bytes, str, Tuple[Union[bytes, str]]],
+    timeout_sec: int,
+    description: Optional[str] = None,
+    echo: bool = False,
+) -> bytes:
+    '''Like expect_match(), but only return the received data'''
+
+    return expect_match(sock, search, timeout_sec, description, echo)[1]
 
 
 def cmd_open(c, ce):
-    global auxverb, downtmp, downtmp_open
+    global auxverb, downtmp, downtmp_open, copy_compressors
     cmdnumargs(c, ce)
     if downtmp:
         bomb("`open' when already open")
+    copy_compressors = None
     caller.hook_open()
     adtlog.debug("auxverb = %s, downtmp = %s" % (str(auxverb), downtmp))
     downtmp = caller.hook_downtmp(downtmp_open)
@@ -382,12 +471,13 @@ def downtmp_remove():
 
 
 def cmd_revert(c, ce):
-    global auxverb, downtmp, downtmp_open
+    global auxverb, downtmp, downtmp_open, copy_compressors
     cmdnumargs(c, ce)
     if not downtmp:
         bomb("`revert' when not open")
     if 'revert' not in caller.hook_capabilities():
         bomb("`revert' when `revert' not advertised")
+    copy_compressors = None
     caller.hook_revert()
     downtmp = caller.hook_downtmp(downtmp_open)
     if downtmp_open and downtmp_open != downtmp:
@@ -398,6 +488,33 @@ def cmd_revert(c, ce):
     return [downtmp]
 
 
+def cmd_save_snapshot(c, ce):
+    cmdnumargs(c, ce, 1)
+    if not downtmp:
+        bomb("`save-snapshot' when not open")
+    if 'snapshot' not in caller.hook_capabilities():
+        bomb("`save-snapshot' when `snapshot' not advertised")
+    caller.hook_save_snapshot(c[1])
+
+
+def cmd_revert_to_snapshot(c, ce):
+    global downtmp, copy_compressors
+    cmdnumargs(c, ce, 1)
+    if not downtmp:
+        bomb("`revert-to-snapshot' when not open")
+    if 'snapshot' not in caller.hook_capabilities():
+        bomb("`revert-to-snapshot' when `snapshot' not advertised")
+    copy_compressors = None
+    caller.hook_revert_to_snapshot(c[1])
+    downtmp = caller.hook_downtmp(downtmp_open)
+    if downtmp_open and downtmp_open != downtmp:
+        bomb('virt-runner failed to restore downtmp path %s, gave %s instead'
+             % (downtmp_open, downtmp))
+    adtlog.debug("auxverb = %s, downtmp = %s" % (str(auxverb), downtmp))
+
+    return [downtmp]
+
+
 def reboot_testbed():
     (systemd_check, out, err) = execute_timeout(
         None, 10, auxverb + ['test', '-d', '/run/systemd/system'],
@@ -472,17 +589,122 @@ def get_downtmp_host():
     return None
 
 
-def copytree(src, dst):
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# cp arguments for copying trees within the testbed or the host
+cp_tree_args = ['cp', '-r', '--preserve=timestamps,links', '--reflink=auto']
+
+
+def copy_stats():
+    '''Return counters for copy_file()'''
+
+    return {'start': time.monotonic(), 'bytes': 0, 'link': 0, 'reflink': 0,
+            'copy_file_range': 0, 'copy': 0}
+
+
+def log_copy_stats(wh, stats):
+    methods = ['%i %s' % (stats[m], m)
+               for m in ('link', 'reflink', 'copy_file_range', 'copy') if stats[m]]
+    if methods:
+        adtlog.debug('%s: %s, %i bytes in %.2fs' % (
+            wh, ', '.join(methods), stats['bytes'],
+            time.monotonic() - stats['start']))
+
+
+def copy_file(src, dst, stats, link=False):
+    '''Copy file src to dst with the cheapest method that works
+
+    Try a hard link if link is True (only for copies which nobody modifies),
+    then a reflink, then copy_file_range() (which lets the kernel or the file
+    system copy without going through user space), and then a normal copy.
+    Like shutil.copy2(), this also copies permissions and modification time.
+    The method gets counted in stats (see copy_stats()). Return dst.
+
+    An existing dst gets replaced, never written into: it might be a hard
+    link to src (e. g. from an earlier copy with link=True that failed
+    later), and truncating it would truncate src as well.
+    '''
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    tmp = os.path.join(os.path.dirname(dst), '.%s.%i.%i.tmp' % (
+        os.path.basename(dst), os.getpid(), threading.get_ident()))
+    try:
+        # left over from a previous process with our pid
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+    try:
+        if link:
+            try:
+                os.link(src, tmp)
+            except OSError:
+                pass
+            else:
+                os.replace(tmp, dst)
+                stats['link'] += 1
+                stats['bytes'] += os.path.getsize(dst)
+                return dst
+
+        with open(src, 'rb') as fsrc, open(tmp, 'xb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            method = None
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                method = 'reflink'
+            except OSError:
+                copied = 0
+                try:
+                    while True:
+                        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30)
+                        if n == 0:
+                            break
+                        copied += n
+                    method = 'copy_file_range'
+                except (OSError, AttributeError):
+                    # not supported between these file systems (or at all); this
+                    # fails before copying anything, so just fall back
+                    if copied:
+                        raise
+            if method is None:
+                shutil.copyfileobj(fsrc, fdst)
+                method = 'copy'
+        shutil.copystat(src, tmp)
+        os.replace(tmp, dst)
+    finally:
+        # rename() does nothing if tmp and dst already were the same file
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+    stats[method] += 1
+    stats['bytes'] += size
+    return dst
+
+
+def copytree(src, dst, stats):
     '''Like shutils.copytree(), but merges with existing dst'''
 
     if not os.path.exists(dst):
-        shutil.copytree(src, dst, symlinks=True)
+        shutil.copytree(src, dst, symlinks=True,
+                        copy_function=partial(copy_file, stats=stats))
         return
 
     for f in os.listdir(src):
         fsrc = os.path.join(src, f)
-        subprocess.check_call(['cp', '-r', '--preserve=timestamps,links',
-                               '--target-directory', dst, fsrc])
+        subprocess.check_call(cp_tree_args + ['--target-directory', dst, fsrc])
+
+
+def remove_partial(path, is_dir):
+    '''Remove what a failed copy left at path'''
+
+    try:
+        if is_dir and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        adtlog.warning('cannot remove partial copy %s: %s' % (path, e))
 
 
 def copyup_shareddir(tb, host, is_dir, downtmp_host):
@@ -503,8 +725,7 @@ def copyup_shareddir(tb, host, is_dir, downtmp_host):
             tb_tmp = os.path.join(downtmp, os.path.basename(host))
             adtlog.debug('copyup_shareddir: tb path %s is not already in '
                          'downtmp, copying to %s' % (tb, tb_tmp))
-            check_exec(['cp', '-r', '--preserve=timestamps,links', tb, tb_tmp],
-                       downp=True)
+            check_exec(cp_tree_args + [tb, tb_tmp], downp=True)
             # translate into host path
             tb = os.path.join(downtmp_host, os.path.basename(host))
 
@@ -513,10 +734,13 @@ def copyup_shareddir(tb, host, is_dir, downtmp_host):
         else:
             adtlog.debug('copyup_shareddir: tb(host) %s is not already at '
                          'destination %s, copying' % (tb, host))
+            # the testbed can still change the files, so no hard links
+            stats = copy_stats()
             if is_dir:
-                copytree(tb, host)
+                copytree(tb, host, stats)
             else:
-                shutil.copy(tb, host)
+                copy_file(tb, host, stats)
+            log_copy_stats('copyup_shareddir', stats)
 
         if tb_tmp:
             adtlog.debug('copyup_shareddir: rm intermediate copy: %s' % tb)
@@ -541,6 +765,9 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
             host = downtmp + host[len(downtmp_host):]
         else:
             host_tmp = os.path.join(downtmp_host, os.path.basename(tb))
+            # if this is only a source for the cp below, hard links are fine
+            link = os.path.join(downtmp, os.path.basename(tb)) != tb
+            stats = copy_stats()
             if is_dir:
                 if os.path.exists(host_tmp):
                     try:
@@ -557,9 +784,17 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
                                 break
                             counter += 1
 
-                shutil.copytree(host, host_tmp, symlinks=True)
-            else:
-                shutil.copy(host, host_tmp)
+            try:
+                if is_dir:
+                    shutil.copytree(host, host_tmp, symlinks=True,
+                                    copy_function=partial(copy_file, stats=stats, link=link))
+                else:
+                    copy_file(host, host_tmp, stats, link=link)
+            except Exception:
+                # don't leave a partial copy (maybe with hard links to host)
+                remove_partial(host_tmp, is_dir)
+                raise
+            log_copy_stats('copydown_shareddir', stats)
             # translate into tb path
             host = os.path.join(downtmp, os.path.basename(tb))
 
@@ -567,14 +802,337 @@ def copydown_shareddir(host, tb, is_dir, downtmp_host):
             host_tmp = None
         else:
             check_exec(['rm', '-rf', tb], downp=True)
-            check_exec(['cp', '-r', '--preserve=timestamps,links', host, tb],
-                       downp=True)
+            try:
+                check_exec(cp_tree_args + [host, tb], downp=True)
+            except Exception:
+                execute_timeout(None, copy_timeout, auxverb + ['rm', '-rf', '--', tb])
+                if host_tmp:
+                    remove_partial(host_tmp, is_dir)
+                raise
         if host_tmp:
             (is_dir and shutil.rmtree or os.unlink)(host_tmp)
     finally:
         timeout_stop()
 
 
+class CopyFailed(RuntimeError):
+    '''A copy failed
+
+    cannot_start is True if a program of the copy could not be started, as
+    opposed to failing while copying (e. g. because the disk is full).
+    '''
+    def __init__(self, cannot_start=False):
+        super().__init__()
+        self.cannot_start = cannot_start
+
+
+def probe_compressors():
+    '''Return the compressors which are available on host and testbed'''
+
+    global copy_compressors
+
+    if copy_compressors is None:
+        copy_compressors = []
+        candidates = [c for c in ('zstd', 'lz4') if shutil.which(c)]
+        if candidates:
+            (status, out, _) = execute_timeout(
+                None, copy_timeout,
+                auxverb + ['sh', '-c', 'for c in "$@"; do '
+                           'if command -v "$c" >/dev/null; then echo "$c"; fi; '
+                           'done', 'sh'] + candidates,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if status == 0:
+                copy_compressors = [c for c in candidates if c in out.split()]
+        adtlog.debug('compressors for copying: %s' %
+                     (' '.join(copy_compressors) or 'none'))
+    return copy_compressors
+
+
+def choose_compression():
+    '''Return the program for compressing directory copies, or None'''
+
+    if copy_compression == 'none':
+        return None
+    available = probe_compressors()
+    if copy_compression != 'auto':
+        if copy_compression not in available:
+            adtlog.debug('%s is not available on host and testbed, copying '
+                         'without compression' % copy_compression)
+            return None
+        return copy_compression
+    return available[0] if available else None
+
+
+def compressor_argv(prog):
+    if prog == 'zstd':
+        # zstd adjusts the level to how fast its output gets consumed, i. e.
+        # the speed of the link to the testbed
+        return ['zstd', '-q', '-c', '-T0', '--adapt=min=1,max=9']
+    return [prog, '-q', '-c', '-1']
+
+
+def list_tree(path, upp):
+    '''Return [(type, nlink, size, relative path)] of the tree at path
+
+    With upp, path is on the testbed. Return None if it cannot be listed.
+    '''
+    entries = []
+    if upp:
+        try:
+            out = subprocess.run(
+                auxverb + ['sh', '-ec', 'cd "$1"; find . -mindepth 1 '
+                           '-printf "%y %n %s %p\\0"', 'sh', path],
+                stdin=devnull_read, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, timeout=copy_timeout,
+                check=True).stdout
+            for entry in out.split(b'\0')[:-1]:
+                (kind, nlink, size, name) = entry.split(b' ', 3)
+                entries.append((kind.decode(), int(nlink), int(size), name))
+        except (subprocess.SubprocessError, ValueError) as e:
+            adtlog.debug('cannot list %s on testbed: %s' % (path, e))
+            return None
+    else:
+        for (root, dirs, files) in os.walk(path):
+            for name in dirs + files:
+                p = os.path.join(root, name)
+                st = os.lstat(p)
+                kind = 'd' if name in dirs and not os.path.islink(p) else 'f'
+                entries.append((kind, st.st_nlink, st.st_size, os.fsencode(
+                    os.path.join('.', os.path.relpath(p, path)))))
+    return entries
+
+
+def split_tree(path, upp):
+    '''Split the tree at path into lists for parallel tar streams
+
+    Return (data lists, metadata list) as NUL separated paths, or None if the
+    tree should be copied with a single tar. The metadata list has the
+    directories and hard links, and has to be copied after the data.
+    '''
+    if copy_streams < 2:
+        return None
+    entries = list_tree(path, upp)
+    if entries is None:
+        return None
+    files = [(size, name) for (kind, nlink, size, name) in entries
+             if kind != 'd' and nlink == 1]
+    if sum(size for (size, _) in files) < copy_split_size:
+        return None
+
+    meta = [b'.'] + [name for (kind, nlink, _, name) in entries
+                     if kind == 'd' or nlink > 1]
+    lists = [[] for i in range(copy_streams)]  # type: List[List[bytes]]
+    loads = [0] * copy_streams
+    for (size, name) in sorted(files, reverse=True):
+        i = loads.index(min(loads))
+        lists[i].append(name)
+        loads[i] += size
+    return ([b'\0'.join(names) + b'\0' for names in lists if names],
+            b'\0'.join(meta) + b'\0')
+
+
+def pump(src, dst, counts, i):
+    '''Copy from pipe src to pipe dst, counting the bytes in counts[i]
+
+    src can also be a bytes object.
+    '''
+    # a process that exits early must not trigger our SIGPIPE handler; this
+    # gets EPIPE instead
+    signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGPIPE])
+    try:
+        if isinstance(src, bytes):
+            dst.write(src)
+        else:
+            while True:
+                block = src.read1(1048576)
+                if not block:
+                    break
+                dst.write(block)
+                counts[i] += len(block)
+    except (BrokenPipeError, ValueError):
+        pass
+    finally:
+        if not isinstance(src, bytes):
+            src.close()
+        try:
+            dst.close()
+        except BrokenPipeError:
+            pass
+
+
+class Pipeline:
+    '''Processes connected by pipes, with byte counts of each pipe'''
+
+    def __init__(self, cmdls, names):
+        '''Start cmdls
+
+        names is None or the NUL separated paths for the stdin of the first tar.
+        '''
+        self.cmdls = cmdls
+        self.procs = []     # type: List[subprocess.Popen]
+        self.threads = []   # type: List[threading.Thread]
+        self.counts = [0] * (len(cmdls) - 1)
+        try:
+            for (i, cmdl) in enumerate(cmdls):
+                adtlog.debug(' +%i %s' % (i, ' '.join(cmdl)))
+                try:
+                    self.procs.append(subprocess.Popen(
+                        cmdl,
+                        stdin=subprocess.PIPE if i > 0 or names is not None else devnull_read,
+                        stdout=subprocess.PIPE if i < len(cmdls) - 1 else subprocess.DEVNULL))
+                except OSError as e:
+                    adtlog.info('cannot start %s: %s' % (cmdl[0], e))
+                    raise CopyFailed(cannot_start=True)
+            pipes = [(self.procs[i].stdout, self.procs[i + 1].stdin, i)
+                     for i in range(len(self.procs) - 1)]
+            if names is not None:
+                pipes.append((names, self.procs[0].stdin, None))
+            for (src, dst, i) in pipes:
+                self.threads.append(threading.Thread(
+                    target=pump, args=(src, dst, self.counts, i), daemon=True))
+                self.threads[-1].start()
+        except BaseException:
+            self.stop()
+            raise
+
+    def wait(self, wh):
+        '''Wait for the processes, raise CopyFailed if one failed'''
+
+        for (i, p) in reversed(list(enumerate(self.procs))):
+            status = p.wait()
+            # the sending end may get a SIGPIPE
+            if not (status == 0 or (i < len(self.procs) - 1 and status == -13)):
+                adtlog.info('%s %s failed, status %d' % (wh, self.cmdls[i][0], status))
+                # this might be the consequence of another one failing; 127
+                # is the shell's "command not found"
+                self.stop()
+                raise CopyFailed(cannot_start=any(p.returncode == 127 for p in self.procs))
+        for t in self.threads:
+            t.join()
+
+    def stop(self):
+        for p in self.procs:
+            if p.returncode is None:
+                p.kill()
+                p.wait()
+        for t in self.threads:
+            t.join()
+
+
+def copy_tree(wh, src, dst, upp, compression):
+    '''Copy directory src to dst with tar
+
+    With upp, src is on the testbed and dst on the host, otherwise the other
+    way round. Raise CopyFailed if this fails.
+    '''
+    remote = shlex.quote(src if upp else dst)
+    local = dst if upp else src
+    tar_c = ['--warning=none']
+    tar_x = ['--warning=none', '--preserve-permissions', '--extract',
+             '--no-same-owner']
+    if compression:
+        compress = compressor_argv(compression)
+        decompress = [compression, '-q', '-d', '-c']
+        tar_remote_prog = ['-I', shlex.quote(
+            ' '.join(compress if upp else [compression, '-q']))]
+        # tar cannot tell us that it failed to start the compressor
+        check_remote = 'command -v %s >/dev/null || exit 127; ' % compression
+    else:
+        tar_remote_prog = []
+        check_remote = ''
+
+    def pipeline(names):
+        if names is None:
+            create = tar_c + ['-c', '.']
+        else:
+            create = tar_c + ['--null', '--no-recursion', '-T', '-', '-c']
+        if upp:
+            cmdls = [auxverb + ['sh', '-ec', '%scd %s; tar %s -f -' % (
+                check_remote, remote, ' '.join(create + tar_remote_prog))]]
+            if compression:
+                cmdls.append(decompress)
+            cmdls.append(['tar', '--directory', local] + tar_x + ['-f', '-'])
+        else:
+            cmdls = [['tar', '--directory', local] + create + ['-f', '-']]
+            if compression:
+                cmdls.append(compress)
+            # parallel streams race for creating the directory
+            cmdls.append(auxverb + ['sh', '-ec', '%sif ! test -d %s; then mkdir -- %s 2>/dev/null || test -d %s; fi; '
+                                    'cd %s; tar %s -f -' % (
+                                        check_remote, remote, remote, remote, remote,
+                                        ' '.join(tar_x + tar_remote_prog))])
+        return cmdls
+
+    def wire_raw(counts):
+        if upp:
+            return (counts[0], counts[-1])
+        return (counts[-1], counts[0])
+
+    split = split_tree(src, upp)
+    start = time.monotonic()
+    if split is None:
+        stages = [[None]]
+    else:
+        # directories and hard links last, so that a read-only directory
+        # cannot break extracting the other streams
+        stages = [split[0], [split[1]]]
+    wire = raw = 0
+    for names_list in stages:
+        pipelines = []  # type: List[Pipeline]
+        try:
+            for names in names_list:
+                pipelines.append(Pipeline(pipeline(names), names))
+            for pl in pipelines:
+                pl.wait(wh)
+        finally:
+            for pl in pipelines:
+                pl.stop()
+        for pl in pipelines:
+            (w, r) = wire_raw(pl.counts)
+            wire += w
+            raw += r
+    elapsed = max(time.monotonic() - start, 0.001)
+    adtlog.debug('%s %s: %i bytes in %.2fs (%.1f MB/s), %i bytes on the wire '
+                 '(%s, %i stream%s, %.1f MB/s)' % (
+                     wh, src, raw, elapsed, raw / elapsed / 1000000, wire,
+                     compression or 'uncompressed',
+                     len(stages[0]), '' if len(stages[0]) == 1 else 's',
+                     wire / elapsed / 1000000))
+
+
+def copyupdown_tree(wh, src, dst, upp):
+    global copy_compressors
+
+    if upp:
+        try:
+            os.mkdir(dst)
+        except (IOError, OSError) as oe:
+            if oe.errno != errno.EEXIST:
+                raise
+
+    compression = choose_compression()
+    timeout_start(copy_timeout)
+    try:
+        try:
+            copy_tree(wh, src, dst, upp, compression)
+        except CopyFailed as e:
+            # other failures (e. g. a full disk) would just happen again
+            if not compression or not e.cannot_start:
+                raise
+            # e. g. the compressor got removed from the testbed; don't try
+            # again until it gets reset
+            adtlog.debug('%s with %s failed, trying again without compression' %
+                         (wh, compression))
+            copy_compressors = []
+            copy_tree(wh, src, dst, upp, None)
+        timeout_stop()
+    except CopyFailed:
+        timeout_stop()
+        raise FailedCmd(['copy-failed'])
+    except Timeout:
+        raise FailedCmd(['timeout'])
+
+
 def copyupdown(c, ce, upp):
     cmdnumargs(c, ce, 2)
     copyupdown_internal(ce[0], c[1:], upp)
@@ -612,45 +1170,26 @@ def copyupdown_internal(wh, sd, upp):
             adtlog.debug('Cannot copy %s to %s through shared dir: %s, falling back to tar' %
                          (sd[0], sd[1], str(e)))
 
+    if dirsp:
+        copyupdown_tree(wh, sd[0], sd[1], upp)
+        return
+
     isrc = 0
     idst = 1
-    ilocal = 0 + upp
     iremote = 1 - upp
 
     deststdout = devnull_read
     srcstdin = devnull_read
     remfileq = shlex.quote(sd[iremote])
-    if not dirsp:
-        rune = 'cat %s%s' % ('><'[upp], remfileq)
-        if upp:
-            deststdout = open(sd[idst], 'wb')
-        else:
-            srcstdin = open(sd[isrc], 'rb')
-            status = os.fstat(srcstdin.fileno())
-            if status.st_mode & 0o111:
-                rune += '; chmod +x -- %s' % (remfileq)
-        localcmdl = ['cat']
+    rune = 'cat %s%s' % ('><'[upp], remfileq)
+    if upp:
+        deststdout = open(sd[idst], 'wb')
     else:
-        taropts = [None, None]
-        taropts[isrc] = '--warning=none -c .'
-        taropts[idst] = '--warning=none --preserve-permissions --extract ' \
-                        '--no-same-owner'
-
-        rune = 'cd %s; tar %s -f -' % (remfileq, taropts[iremote])
-        if upp:
-            try:
-                os.mkdir(sd[ilocal])
-            except (IOError, OSError) as oe:
-                if oe.errno != errno.EEXIST:
-                    raise
-        else:
-            rune = ('if ! test -d %s; then mkdir -- %s; fi; ' % (
-                remfileq, remfileq)
-            ) + rune
-
-        localcmdl = ['tar', '--directory', sd[ilocal]] + (
-            ('%s -f -' % taropts[ilocal]).split()
-        )
+        srcstdin = open(sd[isrc], 'rb')
+        status = os.fstat(srcstdin.fileno())
+        if status.st_mode & 0o111:
+            rune += '; chmod +x -- %s' % (remfileq)
+    localcmdl = ['cat']
     downcmdl = auxverb + ['sh', '-ec', rune]
 
     if upp:
@@ -724,30 +1263,52 @@ def cmd_shell(c, ce):
             adtlog.error('Cannot run shell: %s' % e)
 
 
-def command():
-    sys.stdout.flush()
-    while True:
+def read_command_line():
+    '''Read the next line from the caller on stdin
+
+    This waits in select() until input arrives. It reads the file descriptor
+    directly, as stdin is sometimes switched to non-blocking mode by
+    processes that share it, which makes sys.stdin.readline() return empty
+    strings instead of blocking.
+
+    Return '' on end of file.
+    '''
+    global stdin_buffer
+
+    fd = sys.stdin.fileno()
+    while b'\n' not in stdin_buffer:
+        select.select([fd], [], [])
         try:
-            ce = sys.stdin.readline().strip()
-            # FIXME: This usually means EOF (as checked below), but with Python
-            # 3 we often get empty strings here even though this is supposed to
-            # block for new input.
-            if ce == '':
-                time.sleep(0.1)
-                continue
+            block = os.read(fd, 4096)
+        except BlockingIOError:
+            continue
+        if not block:
             break
-        except IOError as e:
-            if e.errno == errno.EAGAIN:
-                time.sleep(0.1)
-                continue
-            else:
-                raise
-    if not ce:
-        bomb('end of file - caller quit?')
-    ce = ce.rstrip().split()
-    c = list(map(url_unquote, ce))
-    if not c:
-        bomb('empty commands are not permitted')
+        stdin_buffer += block
+
+    (line, nl, stdin_buffer) = stdin_buffer.partition(b'\n')
+    return (line + nl).decode('UTF-8')
+
+
+def read_command():
+    '''Read the next non-empty command line from the caller
+
+    Return (url-unquoted words, raw words).
+    '''
+    while True:
+        line = read_command_line()
+        if not line:
+            bomb('end of file - caller quit?')
+        ce = line.strip()
+        if ce:
+            break
+    ce = ce.split()
+    return (list(map(url_unquote, ce)), ce)
+
+
+def run_command(c, ce):
+    '''Execute a single command and return its reply words'''
+
     adtlog.debug('executing ' + ' '.join(ce))
     c_lookup = c[0].replace('-', '_')
     try:
@@ -761,7 +1322,44 @@ def command():
         r.insert(0, 'ok')
     except FailedCmd as fc:
         r = fc.e
-    print(' '.join(r))
+    return r
+
+
+def cmd_batch(c, ce):
+    '''Run the following N command lines, with tagged replies
+
+    Every command gets a reply line prefixed with its index in the batch,
+    which is written as soon as that command finishes. Once a command fails,
+    the remaining ones are not executed and get a "skipped" reply.
+    '''
+    cmdnumargs(c, ce, 1)
+    try:
+        n = int(c[1])
+    except ValueError:
+        bomb("`batch' needs a number of commands, not `%s'" % ce[1])
+    if n < 0:
+        bomb("`batch' needs a non-negative number of commands")
+
+    batch = [read_command() for i in range(n)]
+    for (bc, bce) in batch:
+        if bc[0] in ('batch', 'shell'):
+            bomb("`%s' is not permitted in a batch" % bce[0])
+
+    failed = False
+    for (i, (bc, bce)) in enumerate(batch):
+        if failed:
+            r = ['skipped']
+        else:
+            r = run_command(bc, bce)
+            failed = r[0] != 'ok'
+        print('%i %s' % (i, ' '.join(r)))
+        sys.stdout.flush()
+
+
+def command():
+    sys.stdout.flush()
+    (c, ce) = read_command()
+    print(' '.join(run_command(c, ce)))
 
 
 signal_list = [signal.SIGHUP, signal.SIGTERM,
@@ -0,0 +1,313 @@
+# adt_aptcache.py is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+
+import hashlib
+import http.server
+import os
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import adtlog
+
+# request headers which we pass on for files that we do not cache
+forward_headers = ['If-Modified-Since', 'If-None-Match', 'If-Range', 'Range',
+                   'Cache-Control']
+# response headers which we pass back to apt
+reply_headers = ['Content-Type', 'Content-Length', 'Content-Range',
+                 'Last-Modified', 'ETag', 'Accept-Ranges']
+
+
+def cacheable(path):
+    '''Check if an archive path never changes its contents
+
+    This is true for packages, whose file names contain the version, and for
+    index files which apt downloads by their hash. Release and index files
+    under their normal names change all the time, so are always passed
+    through.
+    '''
+    return (path.endswith(('.deb', '.udeb', '.ddeb')) or
+            '/by-hash/' in path)
+
+
+class AptCache:
+    '''Content-addressed store of downloaded archive files
+
+    Files are stored once under the SHA256 of their contents in blobs/, and
+    urls/ has a symlink to the blob for each URL that they were downloaded
+    from. The modification time of a blob is its last use, and the least
+    recently used blobs get removed when the total size exceeds max_size.
+
+    All changes are atomic renames, so that several autopkgtest instances
+    can share a cache directory.
+    '''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        self.blobs = os.path.join(path, 'blobs')
+        self.urls = os.path.join(path, 'urls')
+        os.makedirs(self.blobs, exist_ok=True)
+        os.makedirs(self.urls, exist_ok=True)
+
+    def _link(self, url):
+        return os.path.join(self.urls,
+                            hashlib.sha256(url.encode('UTF-8')).hexdigest())
+
+    def get(self, url):
+        '''Return the path of the cached file for url, or None'''
+
+        link = self._link(url)
+        try:
+            os.utime(link, follow_symlinks=True)
+        except FileNotFoundError:
+            return None
+        return link
+
+    def put(self, url, tmpfile, digest):
+        '''Move the finished download tmpfile with SHA256 digest into the cache'''
+
+        blob = os.path.join(self.blobs, digest)
+        if os.path.exists(blob):
+            os.unlink(tmpfile)
+            os.utime(blob)
+        else:
+            os.chmod(tmpfile, 0o644)
+            os.rename(tmpfile, blob)
+        tmplink = os.path.join(self.urls, '.%s.%i.%i' % (
+            digest, os.getpid(), threading.get_ident()))
+        os.symlink(os.path.join('..', 'blobs', digest), tmplink)
+        os.rename(tmplink, self._link(url))
+        self.expire()
+
+    def expire(self):
+        '''Remove least recently used files until the cache fits max_size'''
+
+        blobs = []
+        total = 0
+        for entry in os.scandir(self.blobs):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total <= self.max_size:
+            return
+
+        blobs.sort()
+        for (_, size, path) in blobs:
+            if total <= self.max_size:
+                break
+            adtlog.debug('apt cache: expiring %s' % os.path.basename(path))
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        for entry in os.scandir(self.urls):
+            if not os.path.exists(entry.path):
+                try:
+                    os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class ProxyHandler(http.server.BaseHTTPRequestHandler):
+    '''Answer apt's proxy requests from the AptCache or upstream'''
+
+    def log_message(self, format, *args):
+        adtlog.debug('apt cache: ' + format % args)
+
+    def upstream_url(self):
+        '''Return the URL to fetch for this request, or None if invalid'''
+
+        url = urllib.parse.urlsplit(self.path)
+        if self.server.upstream:
+            # don't let ../ escape from a file:// upstream
+            if (not url.path.startswith('/') or
+                    '..' in urllib.parse.unquote(url.path).split('/')):
+                return None
+            return self.server.upstream.rstrip('/') + url.path
+        if url.scheme != 'http':
+            return None
+        return self.path
+
+    def do_GET(self):
+        url = self.upstream_url()
+        if url is None:
+            self.send_error(400, 'only http:// proxy requests without ".." are supported')
+            return
+
+        if not cacheable(url):
+            self.pass_through(url)
+            return
+
+        cached = self.server.cache.get(url)
+        if cached:
+            try:
+                f = open(cached, 'rb')
+            except FileNotFoundError:
+                # expired in the meantime
+                pass
+            else:
+                with f:
+                    self.log_message('hit %s', url)
+                    self.send_response(200)
+                    self.send_header('Content-Length',
+                                     str(os.fstat(f.fileno()).st_size))
+                    self.end_headers()
+                    shutil.copyfileobj(f, self.wfile)
+                return
+
+        self.log_message('miss %s', url)
+        self.fetch(url)
+
+    def open_upstream(self, url, headers):
+        '''Open url, and send the reply header to apt
+
+        Return the response object, or None if the request failed.
+        '''
+        try:
+            resp = urllib.request.urlopen(
+                urllib.request.Request(url, headers=headers),
+                timeout=self.server.fetch_timeout)
+            code = getattr(resp, 'status', None) or 200
+        except urllib.error.HTTPError as e:
+            resp = e
+            code = e.code
+        except urllib.error.URLError as e:
+            # file:// upstreams
+            if isinstance(e.reason, FileNotFoundError):
+                self.send_error(404)
+            else:
+                self.send_error(502, str(e.reason))
+            return None
+        except OSError as e:
+            self.send_error(502, str(e))
+            return None
+
+        self.send_response(code)
+        if code != 200 and code != 206:
+            # e. g. 304 or 404, don't relay a body
+            for h in ['Last-Modified', 'ETag']:
+                if resp.headers.get(h) is not None:
+                    self.send_header(h, resp.headers[h])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            resp.close()
+            return None
+        for h in reply_headers:
+            if resp.headers.get(h) is not None:
+                self.send_header(h, resp.headers[h])
+        if resp.headers.get('Content-Length') is None:
+            self.close_connection = True
+        self.end_headers()
+        return resp
+
+    def pass_through(self, url):
+        headers = {h: self.headers[h] for h in forward_headers
+                   if self.headers.get(h) is not None}
+        resp = self.open_upstream(url, headers)
+        if resp is not None:
+            with resp:
+                shutil.copyfileobj(resp, self.wfile)
+
+    def fetch(self, url):
+        '''Download url to apt and into the cache at the same time'''
+
+        resp = self.open_upstream(url, {})
+        if resp is None:
+            return
+        with resp:
+            (fd, tmpfile) = tempfile.mkstemp(prefix='.', dir=self.server.cache.blobs)
+            try:
+                sha = hashlib.sha256()
+                length = 0
+                with os.fdopen(fd, 'wb') as f:
+                    while True:
+                        block = resp.read(65536)
+                        if not block:
+                            break
+                        sha.update(block)
+                        f.write(block)
+                        length += len(block)
+                        self.wfile.write(block)
+                expected = resp.headers.get('Content-Length')
+                if expected is not None and int(expected) != length:
+                    raise IOError('short read from %s' % url)
+                self.server.cache.put(url, tmpfile, sha.hexdigest())
+            finally:
+                if os.path.exists(tmpfile):
+                    os.unlink(tmpfile)
+
+
+class ProxyServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ProxyServer6(ProxyServer):
+    address_family = socket.AF_INET6
+
+
+class AptCacheProxy:
+    '''Caching HTTP proxy for apt in the testbed
+
+    This runs in a background thread of autopkgtest. With upstream (an
+    http://, https:// or file:// URL of an archive mirror), requests are
+    answered from that mirror regardless of the host that apt asked for,
+    which also allows running completely offline.
+    '''
+
+    def __init__(self, cache_dir, max_size, listen='127.0.0.1',
+                 upstream=None, timeout=300):
+        if ':' in listen:
+            self.server = ProxyServer6((listen, 0), ProxyHandler)  # type: ProxyServer
+        else:
+            self.server = ProxyServer((listen, 0), ProxyHandler)
+        self.server.cache = AptCache(cache_dir, max_size)
+        self.server.upstream = upstream
+        self.server.fetch_timeout = timeout
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='apt-cache-proxy', daemon=True)
+        self.thread.start()
+        adtlog.debug('apt cache proxy for %s listening on %s:%i' %
+                     (cache_dir, listen, self.port))
+
+    def url(self, address):
+        '''Return the proxy URL for the testbed, which reaches us on address'''
+
+        if ':' in address:
+            address = '[%s]' % address
+        return 'http://%s:%i/' % (address, self.port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
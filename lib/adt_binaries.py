@@ -22,12 +22,79 @@
 
 import os
 import atexit
+import hashlib
 import shutil
 import errno
+import re
+import subprocess
+import tarfile
 
 import adtlog
 import adt_testbed
 
+# (device, inode, size, mtime) of a .deb -> its control file
+_control_cache = {}
+
+
+def deb_control(path):
+    '''Return the control file of the .deb at path
+
+    This reads the control member directly from the ar archive; only if it
+    is compressed with something that Python's tarfile cannot read (like
+    zstd), dpkg-deb is used. Raise ValueError if path is not a valid .deb.
+    '''
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    control = _control_cache.get(key)
+    if control is not None:
+        return control
+
+    with open(path, 'rb') as f:
+        if f.read(8) != b'!<arch>\n':
+            raise ValueError('%s is not a Debian binary package' % path)
+        while True:
+            header = f.read(60)
+            if len(header) < 60 or header[58:60] != b'`\n':
+                raise ValueError('%s has no control member' % path)
+            name = header[:16].rstrip(b' ').rstrip(b'/').decode('ascii', 'replace')
+            size = int(header[48:58])
+            if not name.startswith('control.tar'):
+                # members are aligned to two bytes
+                f.seek(size + size % 2, os.SEEK_CUR)
+                continue
+            if name not in ('control.tar', 'control.tar.gz', 'control.tar.xz',
+                            'control.tar.bz2'):
+                try:
+                    control = subprocess.check_output(['dpkg-deb', '--field', path],
+                                                      universal_newlines=True)
+                except subprocess.CalledProcessError as e:
+                    raise ValueError(str(e))
+                break
+            try:
+                with tarfile.open(fileobj=f, mode='r|*') as tar:
+                    for member in tar:
+                        if member.name in ('./control', 'control') and member.isfile():
+                            control = tar.extractfile(member).read().decode('UTF-8')
+                            break
+            except (tarfile.TarError, EOFError, UnicodeDecodeError) as e:
+                raise ValueError('%s: cannot read %s: %s' % (path, name, e))
+            if control is None:
+                raise ValueError('%s has no control file' % path)
+            break
+
+    control = control.strip('\n') + '\n'
+    _control_cache[key] = control
+    return control
+
+
+def deb_package_name(path):
+    '''Return the package name of the .deb at path'''
+
+    m = re.search(r'^Package:[ \t]*(\S+)', deb_control(path), re.MULTILINE)
+    if not m:
+        raise ValueError('%s has no Package field' % path)
+    return m.group(1)
+
 
 class DebBinaries:
     '''Registration and installation of .debs'''
@@ -45,10 +112,17 @@ class DebBinaries:
             os.path.join(self.testbed.scratch, 'binaries'), is_dir=True)
         os.mkdir(self.dir.host)
         self.registered = set()
+        # pkgname -> Packages stanza
+        self.stanzas = {}
+        self._release = None
+        # Release of the binaries for which the reinstall check ran
+        self._reinstalled_release = None
 
         # clean up an empty binaries output dir
         atexit.register(lambda: os.path.exists(self.dir.host) and (
             os.listdir(self.dir.host) or os.rmdir(self.dir.host)))
+        # atexit handlers run in reverse order, so this comes first
+        atexit.register(self._remove_indexes)
 
         self.need_apt_reset = False
 
@@ -69,61 +143,130 @@ class DebBinaries:
             if oe.errno != errno.EXDEV:
                 raise oe
             shutil.copy(path, dest)
+        self.stanzas[pkgname] = self._stanza(dest)
+        self._release = None
         # clean up locally built debs (what=ubtreeN) to keep a clean
         # --output-dir, but don't clean up --binary arguments
         if path.startswith(self.output_dir):
             atexit.register(lambda f: os.path.exists(f) and os.unlink(f), path)
         self.registered.add(pkgname)
 
-    def publish(self):
+    def _stanza(self, deb):
+        '''Return the Packages index stanza for deb in self.dir'''
+
+        md5 = hashlib.md5()
+        sha256 = hashlib.sha256()
+        size = 0
+        with open(deb, 'rb') as f:
+            while True:
+                block = f.read(1048576)
+                if not block:
+                    break
+                md5.update(block)
+                sha256.update(block)
+                size += len(block)
+
+        try:
+            control = deb_control(deb)
+        except ValueError as e:
+            adtlog.badpkg('failed to parse binary package: %s' % e)
+
+        return '%sFilename: ./%s\nSize: %i\nMD5sum: %s\nSHA256: %s\n' % (
+            control, os.path.basename(deb), size, md5.hexdigest(), sha256.hexdigest())
+
+    def _write_indexes(self):
+        '''Write Packages and Release for the registered debs
+
+        This replaces running apt-ftparchive in the testbed. Return the
+        Release contents.
+        '''
+        if self._release is None:
+            packages = '\n'.join(self.stanzas[p] for p in sorted(self.stanzas)).encode()
+            with open(os.path.join(self.dir.host, 'Packages'), 'wb') as f:
+                f.write(packages)
+            # apt wants a Date; use a fixed one, so that a clock skew between
+            # host and testbed cannot make the Release "not valid yet"
+            self._release = ('Date: Thu, 01 Jan 1970 00:00:00 UTC\n'
+                             'MD5Sum:\n %s %i Packages\nSHA256:\n %s %i Packages\n') % (
+                hashlib.md5(packages).hexdigest(), len(packages),
+                hashlib.sha256(packages).hexdigest(), len(packages))
+            with open(os.path.join(self.dir.host, 'Release'), 'w') as f:
+                f.write(self._release)
+        return self._release
+
+    def _remove_indexes(self):
+        '''Remove Packages and Release, to keep a clean --output-dir'''
+
+        for name in ('Packages', 'Release'):
+            try:
+                os.unlink(os.path.join(self.dir.host, name))
+            except FileNotFoundError:
+                pass
+
+    def publish(self, reinstall=True):
+        '''Make the registered binaries available to apt in the testbed
+
+        Registered packages which are already installed get reinstalled,
+        unless reinstall is False (e. g. because they got installed from
+        the same binaries).
+        '''
         if not self.registered:
             adtlog.debug('Binaries: no registered binaries, not publishing anything')
             return
         adtlog.debug('Binaries: publish')
 
-        # copy binaries directory to testbed; self.dir.tb might have changed
-        # since last time due to a reset, so update it
+        release = self._write_indexes()
+        # self.dir.tb might have changed since last time due to a reset, so
+        # update it
         self.dir.tb = os.path.join(self.testbed.scratch, 'binaries')
-        self.testbed.check_exec(['rm', '-rf', self.dir.tb])
-        self.dir.copydown()
+        source = 'deb [ trusted=yes ] file://%s /' % self.dir.tb
 
-        aptupdate_out = adt_testbed.TempPath(self.testbed, 'apt-update.out')
-        script = '''
-  type apt-ftparchive >/dev/null 2>&1 || DEBIAN_FRONTEND=noninteractive apt-get install -y apt-utils 2>&1
-  (cd %(d)s; apt-ftparchive packages . > Packages; apt-ftparchive release . > Release)
+        # the apt source is up to date if the testbed was not reset since
+        # publishing the same binaries
+        if self.testbed.execute(
+                ['sh', '-ec', 'grep -qxF "$1" /etc/apt/sources.list.d/autopkgtest.list; '
+                 'echo "$2  $3/Release" | sha256sum --check --status',
+                 'sh', source, hashlib.sha256(release.encode()).hexdigest(), self.dir.tb],
+                stderr=subprocess.DEVNULL)[0] == 0:
+            # ... and the installed ones are too if we already checked them
+            # for exactly these binaries
+            if self._reinstalled_release == release or not reinstall:
+                adtlog.debug('Binaries: testbed already has the current binaries')
+                return
+            adtlog.debug('Binaries: testbed already has the current apt source')
+        else:
+            # copy binaries directory to testbed
+            self.testbed.check_exec(['rm', '-rf', self.dir.tb])
+            self.dir.copydown()
+
+            script = '''
   printf 'Package: *\\nPin: origin ""\\nPin-Priority: 1002\\n' > /etc/apt/preferences.d/90autopkgtest
-  echo "deb [ trusted=yes ] file://%(d)s /" >/etc/apt/sources.list.d/autopkgtest.list
+  echo "%(s)s" >/etc/apt/sources.list.d/autopkgtest.list
   if [ "x`ls /var/lib/dpkg/updates`" != x ]; then
     echo >&2 "/var/lib/dpkg/updates contains some files, aargh"; exit 1
   fi
   apt-get --quiet --no-list-cleanup -o Dir::Etc::sourcelist=/etc/apt/sources.list.d/autopkgtest.list -o Dir::Etc::sourceparts=/dev/null update 2>&1
-  cp /var/lib/dpkg/status %(o)s
-  ''' % {'d': self.dir.tb, 'o': aptupdate_out.tb}
-        self.need_apt_reset = True
-        self.testbed.check_exec(['sh', '-ec', script], kind='install')
-
-        aptupdate_out.copyup()
+  ''' % {'s': source}
+            self.need_apt_reset = True
+            self.testbed.check_exec(['sh', '-ec', script], kind='install')
 
-        adtlog.debug('Binaries: publish reinstall checking...')
         pkgs_reinstall = set()
-        pkg = None
-        for line in open(aptupdate_out.host, encoding='UTF-8'):
-            if line.startswith('Package: '):
-                pkg = line[9:].rstrip()
-            elif line.startswith('Status: install '):
-                if pkg in self.registered:
-                    pkgs_reinstall.add(pkg)
-                    adtlog.debug('Binaries: publish reinstall needs ' + pkg)
+        if reinstall:
+            adtlog.debug('Binaries: publish reinstall checking...')
+            pkgs_reinstall = self.registered & self.testbed.installed_packages()[0]
+        for pkg in pkgs_reinstall:
+            adtlog.debug('Binaries: publish reinstall needs ' + pkg)
 
         if pkgs_reinstall:
             rc = self.testbed.execute(
                 ['apt-get', '--quiet', '-o', 'Debug::pkgProblemResolver=true',
                  '-o', 'APT::Get::force-yes=true',
                  '-o', 'APT::Get::Assume-Yes=true',
-                 '--reinstall', 'install'] + list(pkgs_reinstall),
+                 '--reinstall', 'install'] + sorted(pkgs_reinstall),
                 kind='install')[0]
             if rc:
                 adtlog.badpkg('installation of basic binaries failed, exit code %d' % rc)
+        self._reinstalled_release = release
 
         adtlog.debug('Binaries: publish done')
 
@@ -0,0 +1,316 @@
+# adt_deps.py is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 675 Mass Ave, Cambridge, MA 02139, USA.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+#
+# Evaluate dependency fields and architecture wildcards in-process, the same
+# way as dpkg's Dpkg::Deps::deps_parse() and Dpkg::Arch::debarch_is() do.
+# The architecture tables are read from dpkg's data directory.
+
+import functools
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+simple_re = re.compile(r'''
+    ^\s*                           # skip leading whitespace
+    ([a-zA-Z0-9][a-zA-Z0-9+.-]*)   # package name
+    (?:                            # start of optional part
+      :                            # colon for architecture
+      ([a-zA-Z0-9][a-zA-Z0-9-]*)   # architecture name
+    )?                             # end of optional part
+    (?:                            # start of optional part
+      \s* \(                       # open parenthesis for version part
+      \s* (<<|<=|=|>=|>>|[<>])     # relation part
+      \s* ([^\)\s]+)               # do not attempt to parse version
+      \s* \)                       # closing parenthesis
+    )?                             # end of optional part
+    (?:                            # start of optional architecture
+      \s* \[                       # open bracket for architecture
+      \s* ([^\]]+)                 # don't parse architectures now
+      \s* \]                       # closing bracket
+    )?                             # end of optional architecture
+    (
+      (?:                          # start of optional restriction
+      \s* <                        # open bracket for restriction
+      \s* [^>]+                    # do not parse restrictions now
+      \s* >                        # closing bracket
+      )+
+    )?                             # end of optional restriction
+    \s*$                           # trailing spaces at end
+    ''', re.X)
+
+arch_re = re.compile(r'^!?[a-zA-Z0-9][a-zA-Z0-9-]*$')
+
+# deprecated relations, as normalized by dpkg
+relations = {'<': '<=', '>': '>='}
+
+
+class Dep:
+    '''A single package relation, like Dpkg::Deps::Simple'''
+
+    def __init__(self, package: str, archqual: Optional[str] = None,
+                 relation: Optional[str] = None, version: Optional[str] = None,
+                 arches: Optional[List[str]] = None,
+                 restrictions: Optional[List[List[str]]] = None) -> None:
+        self.package = package
+        self.archqual = archqual
+        self.relation = relation
+        self.version = version
+        self.arches = arches
+        self.restrictions = restrictions
+
+    def output(self) -> str:
+        res = self.package
+        if self.archqual is not None:
+            res += ':' + self.archqual
+        if self.relation is not None:
+            res += ' (%s %s)' % (self.relation, self.version)
+        if self.arches is not None:
+            res += ' [%s]' % ' '.join(self.arches)
+        if self.restrictions is not None:
+            for restrlist in self.restrictions:
+                res += ' <%s>' % ' '.join(restrlist)
+        return res
+
+    def arch_is_concerned(self, host_arch: str) -> bool:
+        if self.arches is None:
+            return True
+        return debarch_is_concerned(host_arch, self.arches)
+
+    def profile_is_concerned(self, build_profiles: List[str]) -> bool:
+        if self.restrictions is None:
+            return True
+        return evaluate_restriction_formula(self.restrictions, build_profiles)
+
+
+def _parse_build_profiles(string: str) -> List[List[str]]:
+    string = re.sub(r'^\s*<\s*(.*)\s*>\s*$', r'\1', string, flags=re.S)
+    return [s.split() for s in re.split(r'\s*>\s+<\s*', string)]
+
+
+def parse_simple(dep: str, build_dep: bool = False) -> Dep:
+    '''Parse a single package relation
+
+    Raise ValueError if it is invalid.
+    '''
+    m = simple_re.match(dep)
+    if not m or (m.group(2) == 'native' and not build_dep):
+        raise ValueError("can't parse dependency %s" % dep)
+    arches = None
+    if m.group(5) is not None:
+        arches = m.group(5).split()
+        for arch in arches:
+            if not arch_re.match(arch):
+                raise ValueError("'%s' is not a legal architecture in list '%s'" %
+                                 (arch, m.group(5)))
+    relation = m.group(3)
+    if relation is not None:
+        relation = relations.get(relation, relation)
+    restrictions = None
+    if m.group(6) is not None:
+        restrictions = _parse_build_profiles(m.group(6))
+    return Dep(m.group(1), m.group(2), relation, m.group(4), arches,
+               restrictions)
+
+
+def _split(pattern: str, string: str) -> List[str]:
+    '''Split like perl, which drops trailing empty fields'''
+
+    fields = re.split(pattern, string)
+    while fields and not fields[-1]:
+        fields.pop()
+    return fields
+
+
+def deps_parse(dep_line: str, host_arch: Optional[str] = None,
+               reduce_arch: bool = False, reduce_profiles: bool = False,
+               reduce_restrictions: bool = False, build_dep: bool = False,
+               build_profiles: Optional[List[str]] = None) -> List[List[Dep]]:
+    '''Parse a dependency field like Dpkg::Deps::deps_parse()
+
+    Return a list of alternatives (lists of Dep). With reduce_arch, relations
+    that do not apply to host_arch are dropped, and the architecture lists of
+    the others. reduce_profiles does the same for build profile
+    restrictions; build_profiles default to $DEB_BUILD_PROFILES.
+
+    Raise ValueError if the field or host_arch are invalid.
+    '''
+    if host_arch is not None and debarch_to_debtuple(host_arch) is None:
+        raise ValueError('invalid host_arch %s' % host_arch)
+    if reduce_restrictions:
+        reduce_arch = True
+        reduce_profiles = True
+    if reduce_arch and host_arch is None:
+        raise ValueError('reduce_arch needs a host_arch')
+    if reduce_profiles and build_profiles is None:
+        build_profiles = os.environ.get('DEB_BUILD_PROFILES', '').split()
+
+    dep_line = re.sub(r'\s*[\r\n]\s*', ' ', dep_line).strip()
+    result = []
+    for dep_and in _split(r'\s*,\s*', dep_line):
+        alternatives = []
+        for dep_or in _split(r'\s*\|\s*', dep_and):
+            dep = parse_simple(dep_or, build_dep)
+            if reduce_arch:
+                if not dep.arch_is_concerned(host_arch):
+                    continue
+                dep.arches = None
+            if reduce_profiles:
+                if not dep.profile_is_concerned(build_profiles):
+                    continue
+                dep.restrictions = None
+            alternatives.append(dep)
+        if alternatives:
+            result.append(alternatives)
+    return result
+
+
+def deps_output(deps: List[List[Dep]]) -> str:
+    return ', '.join(' | '.join(d.output() for d in alts) for alts in deps)
+
+
+@functools.lru_cache(maxsize=1024)
+def reduce_deps(dep_line: str, host_arch: str, reduce_arch: bool = False,
+                reduce_profiles: bool = False,
+                reduce_restrictions: bool = False,
+                build_dep: bool = False) -> str:
+    '''Return the dependency field with the given reductions applied
+
+    This is the equivalent of deps_parse(dep_line, ...)->output() in perl.
+    Raise ValueError if the field is invalid.
+    '''
+    return deps_output(deps_parse(
+        dep_line, host_arch=host_arch, reduce_arch=reduce_arch,
+        reduce_profiles=reduce_profiles,
+        reduce_restrictions=reduce_restrictions, build_dep=build_dep))
+
+
+def evaluate_restriction_formula(formula: List[List[str]],
+                                 profiles: List[str]) -> bool:
+    # Restriction formulas are in disjunctive normal form:
+    # (foo AND bar) OR (blub AND bla)
+    for restrlist in formula:
+        for restriction in restrlist:
+            m = re.match(r'(!)?(.+)', restriction)
+            if not m:
+                continue
+            # a negative set profile or a positive unset profile makes this
+            # conjunction false
+            if (m.group(2) in profiles) == bool(m.group(1)):
+                break
+        else:
+            return True
+    return False
+
+
+#
+# Architectures
+#
+
+_debarch_to_debtuple = None     # type: Optional[Dict[str, str]]
+
+
+def _load_tupletable() -> Dict[str, str]:
+    global _debarch_to_debtuple
+
+    if _debarch_to_debtuple is not None:
+        return _debarch_to_debtuple
+
+    datadir = os.environ.get('DPKG_DATADIR', '/usr/share/dpkg')
+    cpus = []
+    with open(os.path.join(datadir, 'cputable'), encoding='UTF-8') as f:
+        for line in f:
+            m = re.match(r'(?!#)(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)', line)
+            if m:
+                cpus.append(m.group(1))
+
+    table = {}
+    tuples = set()
+    with open(os.path.join(datadir, 'tupletable'), encoding='UTF-8') as f:
+        for line in f:
+            m = re.match(r'(?!#)(\S+)\s+(\S+)', line)
+            if not m:
+                continue
+            (debtuple, debarch) = m.groups()
+            if '<cpu>' in debtuple:
+                for cpu in cpus:
+                    dt = debtuple.replace('<cpu>', cpu, 1)
+                    da = debarch.replace('<cpu>', cpu, 1)
+                    if da in table or dt in tuples:
+                        continue
+                    table[da] = dt
+                    tuples.add(dt)
+            else:
+                table[debarch] = debtuple
+                tuples.add(debtuple)
+
+    _debarch_to_debtuple = table
+    return table
+
+
+def debarch_to_debtuple(arch: str) -> Optional[Tuple[str, ...]]:
+    '''Return the (abi, libc, os, cpu) tuple of a Debian architecture'''
+
+    m = re.match(r'linux-([^-]*)', arch)
+    if m:
+        arch = m.group(1)
+    debtuple = _load_tupletable().get(arch)
+    if debtuple is None:
+        return None
+    return tuple(debtuple.split('-', 3))
+
+
+def _debwildcard_to_debtuple(arch: str) -> Optional[Tuple[str, ...]]:
+    debtuple = tuple(arch.split('-', 3))
+    if 'any' in debtuple:
+        return ('any',) * (4 - len(debtuple)) + debtuple
+    return debarch_to_debtuple(arch)
+
+
+@functools.lru_cache(maxsize=1024)
+def debarch_is(real: str, alias: str) -> bool:
+    '''Check if the architecture real matches the wildcard alias'''
+
+    if alias == real or alias == 'any':
+        return True
+
+    real_tuple = debarch_to_debtuple(real)
+    alias_tuple = _debwildcard_to_debtuple(alias)
+    if (real_tuple is None or alias_tuple is None or len(real_tuple) != 4 or
+            len(alias_tuple) != 4):
+        return False
+
+    return all(a == r or a == 'any' for (a, r) in zip(alias_tuple, real_tuple))
+
+
+def debarch_is_concerned(host_arch: str, arches: List[str]) -> bool:
+    '''Check if host_arch matches an architecture restriction list'''
+
+    seen_arch = False
+    for arch in arches:
+        arch = arch.lower()
+        if arch.startswith('!'):
+            if debarch_is(host_arch, arch[1:]):
+                return False
+            # !arch includes by default all other arches
+            # unless they also appear in a !otherarch
+            seen_arch = True
+        elif debarch_is(host_arch, arch):
+            return True
+    return seen_arch
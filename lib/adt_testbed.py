@@ -22,7 +22,9 @@
 
 import os
 import sys
+import contextlib
 import errno
+import functools
 import time
 import traceback
 import re
@@ -31,10 +33,14 @@ import signal
 import subprocess
 import tempfile
 import shutil
+import json
+import hashlib
+import struct
 import urllib.parse
 from typing import Set
 
 import adtlog
+import adt_deps
 import VirtSubproc
 from testdesc import Unsupported
 
@@ -43,6 +49,18 @@ timeouts = {'short': 100, 'copy': 300, 'install': 3000, 'test': 10000,
             'build': 100000}
 
 
+def timed(phase):
+    '''Decorator which accounts the run time of a Testbed method to phase'''
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            with self.timings.phase(phase):
+                return fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
 # When running installed, this is /usr/share/autopkgtest.
 # When running uninstalled, this is the source tree.
 # Either way, it has a setup-commands subdirectory.
@@ -54,7 +72,8 @@ class Testbed:
                  setup_commands=[], setup_commands_boot=[], add_apt_pockets=[],
                  copy_files=[], pin_packages=[], add_apt_sources=[],
                  add_apt_releases=[], apt_default_release=None,
-                 enable_apt_fallback=True, shell_fail=False, needs_internet='run'):
+                 enable_apt_fallback=True, shell_fail=False, needs_internet='run',
+                 apt_proxy=None, snapshot_cache=None):
         self.sp = None
         self.lastsend = None
         self.scratch = None
@@ -63,6 +82,8 @@ class Testbed:
         self.stop_sent = False
         self.dpkg_arch = None
         self.exec_cmd = None
+        self._exec_server = None
+        self.caps = []
         self.output_dir = output_dir
         self.shared_downtmp = None  # testbed's downtmp on the host, if supported
         self.vserver_argv = vserver_argv
@@ -85,14 +106,22 @@ class Testbed:
         self.apt_pin_for_releases = []
         self.enable_apt_fallback = enable_apt_fallback
         self.needs_internet = needs_internet
+        self.apt_proxy = apt_proxy
+        self.snapshot_cache = snapshot_cache
         self.shell_fail = shell_fail
         self.nproc = None
         self.cpu_model = None
         self.cpu_flags = None
         self._created_user = False
+        self._pristine_probed = False
+        # package -> version of the pristine testbed, if we record them
+        self.pristine_packages = None
+        # ((deps, synth_deps), dpkg status checksum) after install_deps()
+        self._deps_satisfied = None
         self._tried_debug = False
         # False if not tried, True if successful, error message if not
         self._tried_provide_sudo = False
+        self.timings = Timings()
 
         try:
             self.devnull = subprocess.DEVNULL
@@ -127,11 +156,12 @@ class Testbed:
         adtlog.info('host %s; command line: %s' % (
             os.uname()[1], ' '.join([shlex.quote(w) for w in sys.argv])))
 
-        self.sp = subprocess.Popen(self.vserver_argv,
-                                   stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE,
-                                   universal_newlines=True)
-        self.expect('ok', 0)
+        with self.timings.phase('start'):
+            self.sp = subprocess.Popen(self.vserver_argv,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       universal_newlines=True)
+            self.expect('ok', 0)
 
     def stop(self):
         adtlog.debug('testbed stop')
@@ -154,6 +184,7 @@ class Testbed:
             self.bomb('testbed gave exit status %d after quit' % ec)
         self.sp = None
 
+    @timed('open')
     def open(self):
         adtlog.debug('testbed open, scratch=%s' % self.scratch)
         if self.scratch is not None:
@@ -164,6 +195,8 @@ class Testbed:
     def post_boot_setup(self):
         '''Setup after (re)booting the test bed'''
 
+        self._start_exec_server()
+
         # provide autopkgtest-reboot command, if reboot is supported; /run is
         # usually "noexec" and /[s]bin might be readonly, so create in /tmp
         if 'reboot' in self.caps and 'root-on-testbed' in self.caps:
@@ -245,13 +278,24 @@ class Testbed:
                 else:
                     self.bomb('testbed boot setup commands failed with status %i' % rc)
 
-    def _opened(self, pl):
+    def _opened(self, pl, info=None, snapshot=False):
+        '''Set up a freshly opened/reverted/rebooted testbed
+
+        pl is the reply to the command that opened it. info are the replies
+        to print-execute-command and capabilities if the caller already
+        batched them with that command. If snapshot is True, the testbed got
+        reverted to a snapshot which already has the testbed setup.
+        '''
         self._tried_provide_sudo = False
         self.scratch = pl[0]
         self.deps_installed = []
+        self._deps_satisfied = None
         self.apt_pin_for_releases = []
-        self.exec_cmd = list(map(urllib.parse.unquote, self.command('print-execute-command', (), 1)[0].split(',')))
-        self.caps = self.command('capabilities', (), None)
+        if info is None:
+            info = self.command_batch([('print-execute-command', (), 1),
+                                       ('capabilities', (), None)])
+        self.exec_cmd = list(map(urllib.parse.unquote, info[0][0].split(',')))
+        self.caps = info[1]
         if self.needs_internet in ['try', 'run']:
             self.caps.append('has_internet')
         adtlog.debug('testbed capabilities: %s' % self.caps)
@@ -265,6 +309,13 @@ class Testbed:
             False,
         ).copydown(mode='0755')
 
+        if snapshot:
+            # the proxy address can change between runs
+            if self.apt_proxy:
+                self._configure_apt_proxy()
+            self.post_boot_setup()
+            return
+
         # provide a default for --user
         if self.user is None and 'root-on-testbed' in self.caps:
             self.user = ''
@@ -296,8 +347,57 @@ class Testbed:
             ) as reader:
                 self.check_exec(['sh', '-euc', reader.read(), 'sh', self.user])
 
+        if self.apt_proxy:
+            self._configure_apt_proxy()
+
         self.run_setup_commands()
 
+        # a revert brings back the same pristine testbed (and we just ran the
+        # same setup commands on it), so what we found out about it the
+        # first time is still valid
+        if self._pristine_probed:
+            adtlog.debug('testbed reverted, reusing dpkg architecture %s, '
+                         'eatmydata %s and pristine package list' %
+                         (self.dpkg_arch, self.eatmydata_prefix))
+        else:
+            self._probe_pristine()
+
+        self.post_boot_setup()
+
+    def _configure_apt_proxy(self):
+        '''Point apt in the testbed to the --apt-cache proxy'''
+
+        if 'root-on-testbed' not in self.caps:
+            adtlog.warning('cannot use the apt cache proxy without root on the testbed')
+            return
+        # don't permanently change the apt configuration of e. g. the host
+        if 'revert' not in self.caps:
+            adtlog.warning('not using the apt cache proxy, as the testbed cannot be reverted')
+            return
+        # e. g. the default 127.0.0.1 is the testbed itself with QEMU or LXC;
+        # perl-base has IO::Socket::IP, without perl just try it
+        url = urllib.parse.urlsplit(self.apt_proxy)
+        if self.execute(['sh', '-ec',
+                         'command -v perl >/dev/null || exit 0; '
+                         'exec perl -MIO::Socket::IP -e \'exit !IO::Socket::IP->new('
+                         'PeerHost => $ARGV[0], PeerPort => $ARGV[1], Timeout => 10)\' '
+                         '"$1" "$2"', 'sh', url.hostname, str(url.port)],
+                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)[0] != 0:
+            adtlog.warning('not using the apt cache proxy, as the testbed cannot connect to '
+                           '%s; use --apt-cache-listen and --apt-cache-address to choose '
+                           'an address that the testbed can reach' % self.apt_proxy)
+            return
+        adtlog.debug('configuring testbed to use apt proxy %s' % self.apt_proxy)
+        # sort after a 01proxy from setup-testbed, so that this wins
+        self.check_exec(['sh', '-ec',
+                         'if [ -d /etc/apt/apt.conf.d ]; then '
+                         'echo "Acquire::http::Proxy \\"$1\\";" > '
+                         '/etc/apt/apt.conf.d/99autopkgtest-apt-cache; fi',
+                         'sh', self.apt_proxy])
+
+    def _probe_pristine(self):
+        '''Determine facts about the freshly opened testbed'''
+
         # determine testbed architecture
         self.dpkg_arch = self.check_exec(['dpkg', '--print-architecture'], True).strip()
         adtlog.info('testbed dpkg architecture: ' + self.dpkg_arch)
@@ -313,33 +413,54 @@ class Testbed:
             self.eatmydata_prefix = [out.strip()]
 
         # record package versions of pristine testbed
-        if self.output_dir and self.execute(
-            ['sh', '-ec', 'command -v dpkg-query'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )[0] == 0:
-            pkglist = TempPath(self, 'testbed-packages', autoclean=False)
-            self.check_exec(['sh', '-ec', "dpkg-query --show -f '${Package}\\t${Version}\\n' > %s" % pkglist.tb])
-            pkglist.copyup()
+        self.pristine_packages = None
+        if self.output_dir:
+            listing = self._package_versions()
+            if listing is not None:
+                with open(os.path.join(self.output_dir, 'testbed-packages'), 'w') as f:
+                    f.write(listing)
+                self.pristine_packages = dict(
+                    line.split('\t', 1) for line in listing.splitlines())
 
-        self.post_boot_setup()
+        self._pristine_probed = True
 
     def close(self):
         adtlog.debug('testbed close, scratch=%s' % self.scratch)
         if self.scratch is None:
             return
         self.scratch = None
+        self._pristine_probed = False
+        self._stop_exec_server()
         if self.sp is None:
             return
         self.command('close')
         self.shared_downtmp = None
 
+    @timed('reboot')
     def reboot(self, prepare_only=False):
         '''Reboot the testbed'''
 
+        self._stop_exec_server()
         self.command('reboot', prepare_only and ('prepare-only', ) or ())
         self.post_boot_setup()
 
+    def _start_exec_server(self):
+        '''(Re)start the ExecServer for running short commands'''
+
+        self._stop_exec_server()
+        VirtSubproc.timeout_start(timeouts['short'])
+        try:
+            self._exec_server = ExecServer.start(self.exec_cmd)
+            VirtSubproc.timeout_stop()
+        except VirtSubproc.Timeout:
+            self.debug_fail()
+            self.bomb('timed out on starting exec server')
+
+    def _stop_exec_server(self):
+        if self._exec_server:
+            self._exec_server.stop()
+            self._exec_server = None
+
     def run_setup_commands(self):
         '''Run --setup-commmands and --copy'''
 
@@ -462,6 +583,7 @@ class Testbed:
                 adtlog.info('rebooting testbed after setup commands that affected boot')
                 self.reboot()
 
+    @timed('reset')
     def reset(self, deps_new):
         '''Reset the testbed, if possible and necessary'''
 
@@ -471,18 +593,117 @@ class Testbed:
                 self.modified or
                 [d for d in self.deps_installed if d not in deps_new]):
             adtlog.debug('testbed reset')
-            pl = self.command('revert', (), 1)
-            self._opened(pl)
+            self._stop_exec_server()
+            (pl, *info) = self.command_batch([('revert', (), 1),
+                                              ('print-execute-command', (), 1),
+                                              ('capabilities', (), None)])
+            self._opened(pl, info)
         self.modified = False
 
+    @timed('install_deps')
     def install_deps(self, deps_new, shell_on_failure=False, synth_deps=[]):
-        '''Install dependencies into testbed'''
+        '''Install dependencies into testbed
+
+        Return True if this reverted the testbed to a --snapshot-cache
+        snapshot. Its apt configuration still has the local binaries
+        repository, but they need to be published again, as the scratch
+        space is empty.
+        '''
         adtlog.debug('install_deps: deps_new=%s' % deps_new)
 
         self.deps_installed = deps_new
         if not deps_new:
             return
-        self.satisfy_dependencies_string(', '.join(deps_new), 'install-deps', shell_on_failure=shell_on_failure, synth_deps=synth_deps)
+
+        # skip apt if the previous test had the same dependencies and did not
+        # change the installed packages
+        key = (set(deps_new), set(synth_deps))
+        if self._deps_satisfied is not None and self._deps_satisfied[0] == key:
+            status = self._dpkg_status_checksum()
+            if status is not None and status == self._deps_satisfied[1]:
+                adtlog.info('dependencies are still installed from the previous test')
+                return
+
+        self._deps_satisfied = None
+        snapshot_key = self._snapshot_key(deps_new, synth_deps)
+        reverted = bool(snapshot_key) and self._revert_to_snapshot(snapshot_key)
+        if reverted:
+            self.deps_installed = deps_new
+        else:
+            self.satisfy_dependencies_string(', '.join(deps_new), 'install-deps', shell_on_failure=shell_on_failure, synth_deps=synth_deps)
+            if snapshot_key:
+                self._save_snapshot(snapshot_key)
+        self._deps_satisfied = (key, self._dpkg_status_checksum())
+        return reverted
+
+    def _snapshot_key(self, deps, synth_deps):
+        '''Return the --snapshot-cache key for installing deps, or None
+
+        This covers everything that determines the result of installing deps
+        with apt: the virt server (which defines the testbed and the snapshot
+        format), the architecture-resolved dependencies, and the testbed's
+        apt configuration, apt indexes and installed packages.
+        '''
+        if (self.snapshot_cache is None or 'snapshot' not in self.caps or
+                'root-on-testbed' not in self.caps):
+            return None
+
+        (rc, state, err) = self.execute(
+            ['sh', '-c', '(for f in /etc/apt/apt.conf.d/*; do '
+             '[ "$f" = /etc/apt/apt.conf.d/99autopkgtest-apt-cache ] || cat "$f"; done; '
+             'cat /etc/apt/sources.list /etc/apt/sources.list.d/* '
+             '/etc/apt/preferences /etc/apt/preferences.d/* '
+             '/var/lib/apt/lists/*Release /var/lib/dpkg/status) '
+             '2>/dev/null | sha256sum'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if rc != 0:
+            adtlog.warning('cannot determine testbed package state for --snapshot-cache: %s' % err.strip())
+            return None
+
+        key = json.dumps([self.vserver_argv, self.dpkg_arch,
+                          self.resolve_dependencies(', '.join(deps)),
+                          sorted(map(str, synth_deps)), state.split()[0]])
+        key = hashlib.sha256(key.encode('UTF-8')).hexdigest()
+        adtlog.debug('install-deps: snapshot key %s' % key)
+        return key
+
+    def _revert_to_snapshot(self, key):
+        '''Revert to the snapshot for key, if it is in the cache
+
+        Like after revert, the scratch space is empty then, so that nothing
+        from the time of saving the snapshot is left in it. Return True on
+        success.
+        '''
+        path = self.snapshot_cache.lookup(key)
+        if path is None:
+            return False
+        adtlog.info('reverting testbed to snapshot with installed dependencies')
+        self._stop_exec_server()
+        (pl, *info) = self.command_batch([('revert-to-snapshot', (path,), 1),
+                                          ('print-execute-command', (), 1),
+                                          ('capabilities', (), None)])
+        self._opened(pl, info, snapshot=True)
+        return True
+
+    def _save_snapshot(self, key):
+        path = self.snapshot_cache.new_path(key)
+        adtlog.debug('saving testbed snapshot %s' % key)
+        try:
+            self.command('save-snapshot', (path,))
+        except Exception:
+            self.snapshot_cache.discard(path)
+            raise
+        self.snapshot_cache.add(path, key)
+
+    def _dpkg_status_checksum(self):
+        '''Return a checksum of the testbed's dpkg status, or None'''
+
+        (rc, out, _) = self.execute(['md5sum', '/var/lib/dpkg/status'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        if rc != 0:
+            return None
+        return out.split()[0]
 
     def _provide_sudo(self) -> str:
         '''
@@ -612,7 +833,7 @@ class Testbed:
 
     def send(self, string):
         try:
-            adtlog.debug('sending command to testbed: ' + string)
+            adtlog.debug('sending command to testbed: %s', string)
             self.sp.stdin.write(string)
             self.sp.stdin.write('\n')
             self.sp.stdin.flush()
@@ -621,7 +842,14 @@ class Testbed:
             self.debug_fail()
             self.bomb('cannot send to testbed: %s' % e)
 
-    def expect(self, keyword, nresults):
+    def expect(self, keyword, nresults, tag=None):
+        '''Read a reply line from the testbed and check it
+
+        If tag is given, the reply must be prefixed with it, as in the
+        replies to a batch.
+
+        Return the reply words after the keyword.
+        '''
         line = self.sp.stdout.readline()
         if not line:
             self.debug_fail()
@@ -629,11 +857,17 @@ class Testbed:
         if not line.endswith('\n'):
             self.bomb('unterminated line from the testbed')
         line = line.rstrip('\n')
-        adtlog.debug('got reply from testbed: ' + line)
+        adtlog.debug('got reply from testbed: %s', line)
         ll = line.split()
         if not ll:
             self.bomb('unexpected whitespace-only line from the testbed')
-        if ll[0] != keyword:
+        if tag is not None:
+            if ll[0] != tag:
+                self.debug_fail()
+                self.bomb("sent `%s', got `%s', expected reply tagged `%s'" %
+                          (self.lastsend, line, tag))
+            ll = ll[1:]
+        if not ll or ll[0] != keyword:
             self.debug_fail()
 
             if self.lastsend is None:
@@ -649,7 +883,8 @@ class Testbed:
                       (self.lastsend, line, len(ll), nresults))
         return ll
 
-    def command(self, cmd, args=(), nresults=0, unquote=True):
+    @staticmethod
+    def _command_line(cmd, args=()):
         # pass args=[None,...] or =(None,...) to avoid more url quoting
         if type(cmd) is str:
             cmd = [cmd]
@@ -657,13 +892,43 @@ class Testbed:
             args = args[1:]
         else:
             args = list(map(urllib.parse.quote, args))
-        al = cmd + args
-        self.send(' '.join(al))
-        ll = self.expect('ok', nresults)
+        return ' '.join(cmd + args)
+
+    def command(self, cmd, args=(), nresults=0, unquote=True):
+        with self.timings.phase('virt-' + self._command_line(cmd).split()[0]):
+            self.send(self._command_line(cmd, args))
+            ll = self.expect('ok', nresults)
         if unquote:
             ll = list(map(urllib.parse.unquote, ll))
         return ll
 
+    def command_batch(self, commands):
+        '''Run several virt server commands in a single round trip
+
+        commands is a list of (cmd, args, nresults) tuples, as for command().
+        If the virt server does not advertise the "batch" capability, the
+        commands are sent one after the other.
+
+        Return the list of url-unquoted results of each command.
+        '''
+        if len(commands) < 2 or 'batch' not in self.caps:
+            return [self.command(cmd, args, nresults)
+                    for (cmd, args, nresults) in commands]
+
+        lines = [self._command_line(cmd, args) for (cmd, args, _) in commands]
+        self.send('\n'.join(['batch %i' % len(lines)] + lines))
+        results = []
+        for (i, (line, (_, _, nresults))) in enumerate(zip(lines, commands)):
+            # the virt server runs the commands one after the other, so each
+            # takes the time until its reply
+            with self.timings.phase('virt-' + line.split()[0]):
+                self.lastsend = line
+                ll = self.expect('ok', nresults, tag=str(i))
+            results.append(list(map(urllib.parse.unquote, ll)))
+        self.lastsend = 'batch %i' % len(lines)
+        self.expect('ok', 0)
+        return results
+
     def execute(self, argv, xenv=[], stdout=None, stderr=None, kind='short'):
         '''Run command in testbed.
 
@@ -680,19 +945,40 @@ class Testbed:
             env.append('APT_LISTBUGS_FRONTEND=none')
             env.append('APT_LISTCHANGES_FRONTEND=none')
 
-        adtlog.debug('testbed command %s, kind %s, sout %s, serr %s, env %s' %
-                     (argv, kind, stdout and 'pipe' or 'raw',
-                      stderr and 'pipe' or 'raw', env))
+        adtlog.debug('testbed command %s, kind %s, sout %s, serr %s, env %s',
+                     argv, kind, stdout and 'pipe' or 'raw',
+                     stderr and 'pipe' or 'raw', env)
+        if stdout is None or stderr is None:
+            # the command writes to our stdout/stderr directly
+            adtlog.flush()
 
         if env:
             argv = ['env'] + env + argv
 
+        start = time.monotonic()
         VirtSubproc.timeout_start(timeouts[kind])
         try:
-            proc = subprocess.Popen(self.exec_cmd + argv,
-                                    stdin=self.devnull,
-                                    stdout=stdout, stderr=stderr)
-            (out, err) = proc.communicate()
+            # short commands are the most frequent ones, and the execute
+            # command's startup time dominates their run time
+            rc = None
+            if self._exec_server and kind == 'short':
+                proc = self._exec_server.proc
+                try:
+                    (rc, out, err) = self._exec_server.run(argv, stdout, stderr)
+                except ExecServerError as e:
+                    self._stop_exec_server()
+                    if not e.not_run:
+                        # running it again could run it twice
+                        VirtSubproc.timeout_stop()
+                        self.debug_fail()
+                        self.bomb('%s while running command "%s"' % (e, ' '.join(argv)))
+                    adtlog.debug('%s, running commands separately from now on', e)
+            if rc is None:
+                proc = subprocess.Popen(self.exec_cmd + argv,
+                                        stdin=self.devnull,
+                                        stdout=stdout, stderr=stderr)
+                (out, err) = proc.communicate()
+                rc = proc.returncode
             if out is not None:
                 out = out.decode()
             if err is not None:
@@ -706,6 +992,8 @@ class Testbed:
             adtlog.debug('timed out on %s %s (kind: %s)' % (self.exec_cmd, argv, kind))
             if 'sudo' not in self.exec_cmd:
                 proc.wait()
+            if self._exec_server and proc is self._exec_server.proc:
+                self._exec_server = None
             msg = 'timed out on command "%s" (kind: %s)' % (' '.join(argv), kind)
             if kind == 'test':
                 adtlog.error(msg)
@@ -713,14 +1001,16 @@ class Testbed:
             else:
                 self.debug_fail()
                 self.bomb(msg)
+        finally:
+            self.timings.add('execute-' + kind, time.monotonic() - start)
 
-        adtlog.debug('testbed command exited with code %i' % proc.returncode)
+        adtlog.debug('testbed command exited with code %i', rc)
 
-        if proc.returncode in (254, 255):
+        if rc in (254, 255):
             self.debug_fail()
-            self.bomb('testbed auxverb failed with exit code %i' % proc.returncode)
+            self.bomb('testbed auxverb failed with exit code %i' % rc)
 
-        return (proc.returncode, out, err)
+        return (rc, out, err)
 
     def check_exec(self, argv, stdout=False, kind='short'):
         '''Run argv in testbed.
@@ -741,37 +1031,45 @@ class Testbed:
                       adtlog.AutopkgtestError)
         return out
 
-    def is_real_package_installed(self, package):
-        '''Check if a non-virtual package is installed in the testbed'''
-        (rc, out, err) = self.execute(['dpkg-query', '--show', '-f', '${Status}', package],
-                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def _package_versions(self):
+        '''Return the installed packages as "package<TAB>version" lines
+
+        Return None if the testbed does not have dpkg-query.
+        '''
+        (rc, out, err) = self.execute(
+            ['sh', '-ec', 'command -v dpkg-query >/dev/null || exit 127; '
+             "dpkg-query --show -f '${Package}\\t${Version}\\n'"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if rc == 127:
+            return None
         if rc != 0:
-            if 'no packages found' in err:
-                return False
-            self.badpkg('Failed to run dpkg-query: %s (exit code %d)' % (err, rc))
-        if out == 'install ok installed':
-            return True
-        return False
+            self.bomb('Failed to run dpkg-query: %s (exit code %d)' % (err, rc))
+        return out
+
+    def installed_packages(self):
+        '''Return the packages which are installed in the testbed
 
-    def is_virtual_package_installed(self, package):
-        '''Check if a package is installed in the testbed'''
-        (rc, out, err) = self.execute(['dpkg-query', '--show', '-f', '${Status} ${Provides}\n', '*'],
+        Return a pair of sets: the installed (real) packages, and the virtual
+        packages which they provide.
+        '''
+        (rc, out, err) = self.execute(['dpkg-query', '--show', '-f',
+                                       '${Status}\t${binary:Package}\t${Package}\t${Provides}\n'],
                                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if rc != 0:
             self.badpkg('Failed to run dpkg-query: %s (exit code %d)' % (err, rc))
-            return False
-        if not out:
-            return False
+        real = set()
+        provided = set()
         for line in out.splitlines():
-            prefix = 'install ok installed '
-            if not line.startswith(prefix):
+            (status, binary_pkg, pkg, provides) = line.split('\t')
+            if status != 'install ok installed':
                 continue
-            line = line[len(prefix):]
-            for p in line.split(','):
-                (p, _, _) = p.lstrip().partition(' ')  # ' foo (== 1.0)' => 'foo'
-                if p == package:
-                    return True
-        return False
+            real.add(pkg)
+            real.add(binary_pkg)
+            for p in provides.split(','):
+                (p, _, _) = p.lstrip().partition(' ')  # ' foo (= 1.0)' => 'foo'
+                if p:
+                    provided.add(p)
+        return (real, provided)
 
     def _run_apt_install(self, what, prefix, ignorerc=False):
         '''actually run apt-get install'''
@@ -837,12 +1135,14 @@ Description: satisfy autopkgtest test dependencies
             try:
                 self._run_apt_install('--fix-broken', ' '.join(self.eatmydata_prefix))
                 need_explicit_install = []
+                if synth_deps:
+                    (installed_real, installed_virtual) = self.installed_packages()
                 for dep in synth_deps:
                     if dep != list(dep):
                         # simple test dependency (no alternatives)
-                        if self.is_real_package_installed(dep):
+                        if dep in installed_real:
                             continue
-                        if self.is_virtual_package_installed(dep):
+                        if dep in installed_virtual:
                             need_explicit_install.append(dep)
                             continue
                         adtlog.warning('package %s is not installed though it should be' % dep)
@@ -851,11 +1151,11 @@ Description: satisfy autopkgtest test dependencies
                         installed_virtual_packages = []
                         found_a_real_package = False
                         for pkg in dep:
-                            if self.is_real_package_installed(pkg):
+                            if pkg in installed_real:
                                 # no need to install anything from this set of alternatives
                                 found_a_real_package = True
                                 break
-                            if self.is_virtual_package_installed(pkg):
+                            if pkg in installed_virtual:
                                 installed_virtual_packages.append(pkg)
                         if found_a_real_package:
                             continue
@@ -949,38 +1249,31 @@ Description: satisfy autopkgtest test dependencies
 
         self.execute(['dpkg', '--purge', 'autopkgtest-satdep'])
 
-    def satisfy_dependencies_string(self, deps, what,
-                                    build_dep=False, shell_on_failure=False, synth_deps=[]):
-        '''Install dependencies from a string into the testbed'''
-
-        adtlog.debug('%s: satisfying %s' % (what, deps))
+    def resolve_dependencies(self, deps, build_dep=False):
+        '''Resolve architecture restrictions in a dependency string
 
+        Return the dependencies which apply to the testbed's architecture.
+        '''
         # ignore ":native" tags, apt cannot parse them and deps_parse() does
         # not seem to have an option to get rid of them; we always test on the
         # native platform
         deps = deps.replace(':native', '')
 
-        # resolve arch specific dependencies; don't use universal_newlines
-        # here, it's broken for stdin on Python 3.2
-        if build_dep:
-            extra_args = ', reduce_profiles => $supports_profiles, build_dep => 1'
-        else:
-            extra_args = ''
-        perl = subprocess.Popen(['perl', '-'], stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
-        code = '''use Dpkg::Deps;
-                  $supports_profiles = ($Dpkg::Deps::VERSION gt '1.04' or 0);
-                  $origdeps = '%s';
-                  $origdeps =~ s/(^|,)[^<,]+<[^!,>]+>//g if (!$supports_profiles);
-                  $dep = deps_parse($origdeps, reduce_arch => 1, host_arch => '%s' %s);
-                  $out = $dep->output();
-                  # fall back to ignoring build profiles
-                  $out =~ s/ <![^ >]+>//g if (!$supports_profiles);
-                  print $out, "\\n";
-                  ''' % (deps, self.dpkg_arch, extra_args)
-        deps = perl.communicate(code.encode('UTF-8'))[0].decode('UTF-8').strip()
-        if perl.returncode != 0:
-            self.bomb('failed to run perl for parsing dependencies')
+        # resolve arch specific dependencies
+        try:
+            return adt_deps.reduce_deps(deps, self.dpkg_arch, reduce_arch=True,
+                                        reduce_profiles=build_dep,
+                                        build_dep=build_dep)
+        except ValueError as e:
+            self.bomb('failed to parse dependencies %s: %s' % (deps, e))
+
+    def satisfy_dependencies_string(self, deps, what,
+                                    build_dep=False, shell_on_failure=False, synth_deps=[]):
+        '''Install dependencies from a string into the testbed'''
+
+        adtlog.debug('%s: satisfying %s' % (what, deps))
+
+        deps = self.resolve_dependencies(deps, build_dep)
         adtlog.debug('%s: architecture resolved: %s' % (what, deps))
 
         # check if we can use apt-get
@@ -1017,6 +1310,7 @@ Description: satisfy autopkgtest test dependencies
         adtlog.info(' - - - - - - - - - - running shell - - - - - - - - - -')
         self.command('shell', [cwd or '/'] + extra_env)
 
+    @timed('run_test')
     def run_test(self, tree, test, extra_env=[], shell_on_failure=False,
                  shell=False, build_parallel=None):
         '''Run given test in testbed
@@ -1031,26 +1325,14 @@ Description: satisfy autopkgtest test dependencies
         if test.path and not os.path.exists(os.path.join(tree.host, test.path)):
             self.badpkg('%s does not exist' % test.path)
 
-        # record installed package versions
-        if self.output_dir and self.execute(
-            ['sh', '-ec', 'command -v dpkg-query'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )[0] == 0:
-            pkglist = TempPath(self, test.name + '-packages.all', autoclean=False)
-            self.check_exec([
-                'sh', '-ec', "dpkg-query --show -f '${Package}\\t${Version}\\n' > %s" % pkglist.tb])
-            pkglist.copyup()
-
-            # filter out packages from the base system
-            with open(pkglist.host[:-4], 'w') as out:
-                join = subprocess.Popen(['join', '-v2', '-t\t',
-                                         os.path.join(self.output_dir, 'testbed-packages'), pkglist.host],
-                                        stdout=out, env={})
-                join.communicate()
-                if join.returncode != 0:
-                    self.badpkg('failed to call join for test specific package list, code %d' % join.returncode)
-            os.unlink(pkglist.host)
+        # record installed package versions, without the packages from the
+        # base system
+        if self.pristine_packages is not None:
+            listing = self._package_versions() or ''
+            with open(os.path.join(self.output_dir, test.name + '-packages'), 'w') as out:
+                for line in listing.splitlines(keepends=True):
+                    if line.split('\t', 1)[0] not in self.pristine_packages:
+                        out.write(line)
 
         # ensure our tests are in the testbed
         tree.copydown(check_existing=True)
@@ -1179,17 +1461,21 @@ Description: satisfy autopkgtest test dependencies
                 adtlog.debug('no reboot marker, considering a failure')
             break
 
-        # give the setup_trace() cats some time to catch up
-        sys.stdout.flush()
-        sys.stderr.flush()
-        time.sleep(0.3)
+        # let the test output reach the log before our own
+        adtlog.sync_output()
         _info('-----------------------]')
         adtlog.debug('testbed executing test finished with exit status %i' % rc)
 
-        # copy stdout/err files to host
+        # copy stdout/err files and artifacts (if we have --output-dir) to
+        # host in one batch
+        results = [so, se]
+        ap = None
+        if self.output_dir:
+            ap = Path(self, os.path.join(self.output_dir, 'artifacts'),
+                      test_artifacts, is_dir=True)
+            results.append(ap)
         try:
-            so.copyup()
-            se.copyup()
+            Path.copyup_many(results)
             se_size = os.path.getsize(se.host)
         except adtlog.TestbedFailure:
             if timeout:
@@ -1204,9 +1490,7 @@ Description: satisfy autopkgtest test dependencies
                 raise
 
         # avoid mixing up stdout (from report) and stderr (from logging) in output
-        sys.stdout.flush()
-        sys.stderr.flush()
-        time.sleep(0.1)
+        adtlog.sync_output()
 
         _info(' - - - - - - - - - - results - - - - - - - - - -')
 
@@ -1239,8 +1523,8 @@ Description: satisfy autopkgtest test dependencies
             so.autoclean = True
 
         if se_size != 0 and 'allow-stderr' not in test.restrictions:
-            # give tee processes some time to catch up, to avoid mis-ordered logs
-            time.sleep(0.2)
+            # avoid mis-ordered logs
+            adtlog.sync_output()
             _info(' - - - - - - - - - - stderr - - - - - - - - - -')
             with open(se.host, 'rb') as f:
                 while True:
@@ -1254,14 +1538,10 @@ Description: satisfy autopkgtest test dependencies
             if se_size == 0:
                 se.autoclean = True
 
-        # copy artifacts to host, if we have --output-dir
-        if self.output_dir:
-            ap = Path(self, os.path.join(self.output_dir, 'artifacts'),
-                      test_artifacts, is_dir=True)
-            ap.copyup()
-            # don't keep an empty artifacts dir around
-            if not os.listdir(ap.host):
-                os.rmdir(ap.host)
+        # don't keep an empty artifacts dir around; it does not exist if
+        # copying up failed after a timeout
+        if ap is not None and os.path.isdir(ap.host) and not os.listdir(ap.host):
+            os.rmdir(ap.host)
 
         if shell or (shell_on_failure and not test.result):
             self.run_shell(tree.tb, ['AUTOPKGTEST_ARTIFACTS="%s"' % test_artifacts,
@@ -1369,6 +1649,294 @@ Description: satisfy autopkgtest test dependencies
         self.check_exec(['sh', '-ec', script, 'sh', source, filename])
 
 
+class SnapshotCache:
+    '''Host directory of testbed snapshots for --snapshot-cache
+
+    Snapshots are files named after their key. The modification time of a
+    snapshot is its last use, and the least recently used ones get removed
+    when the total size exceeds max_size.
+    '''
+
+    def __init__(self, path, max_size):
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def lookup(self, key):
+        '''Return the path of the snapshot for key, or None'''
+
+        path = os.path.join(self.path, key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def new_path(self, key):
+        '''Return a temporary path for saving a new snapshot for key'''
+
+        return os.path.join(self.path, '.%s.%i' % (key, os.getpid()))
+
+    def discard(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def add(self, path, key):
+        '''Move the snapshot saved to new_path(key) into the cache'''
+
+        os.rename(path, os.path.join(self.path, key))
+        self.expire()
+
+    def expire(self):
+        snapshots = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.'):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            snapshots.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        for (_, size, path) in sorted(snapshots):
+            if total <= self.max_size:
+                break
+            adtlog.debug('removing least recently used snapshot %s' %
+                         os.path.basename(path))
+            self.discard(path)
+            total -= size
+
+
+class Timings:
+    '''Time spent in the phases of a run
+
+    For every phase, this counts how often it happened, the seconds spent in
+    it and, for copies, the bytes which were copied. This is recorded for the
+    whole run and for the test which is set as test at the time. Phases nest,
+    e. g. "run_test" contains "copydown" and "execute-test" (the test
+    itself).
+    '''
+    def __init__(self):
+        self.started = time.monotonic()
+        self.test = None
+        # phase -> {'count': ..., 'seconds': ..., ['bytes': ...]}
+        self.phases = {}
+        # test name -> phases of that test
+        self.tests = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Account the time of the with block to phase name
+
+        This yields a dict in which the block can set 'bytes'.
+        '''
+        timing = {}
+        start = time.monotonic()
+        try:
+            yield timing
+        finally:
+            self.add(name, time.monotonic() - start, timing.get('bytes'))
+
+    def add(self, name, seconds, nbytes=None):
+        phase_dicts = [self.phases]
+        if self.test is not None:
+            phase_dicts.append(self.tests.setdefault(self.test, {}))
+        for phases in phase_dicts:
+            Timings._add(phases, name, 1, seconds, nbytes)
+
+    @staticmethod
+    def _add(phases, name, count, seconds, nbytes):
+        p = phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+        p['count'] += count
+        p['seconds'] += seconds
+        if nbytes is not None:
+            p['bytes'] = p.get('bytes', 0) + nbytes
+
+    def merge(self, info):
+        '''Add the phases of another run, as returned by as_dict()'''
+
+        for (name, p) in info.get('phases', {}).items():
+            Timings._add(self.phases, name, p['count'], p['seconds'], p.get('bytes'))
+        for (test, phases) in info.get('tests', {}).items():
+            for (name, p) in phases.items():
+                Timings._add(self.tests.setdefault(test, {}), name,
+                             p['count'], p['seconds'], p.get('bytes'))
+
+    def as_dict(self):
+        '''Return the timings for testinfo.json'''
+
+        def rounded(phases):
+            return {name: dict(p, seconds=round(p['seconds'], 3))
+                    for (name, p) in sorted(phases.items())}
+
+        return {'seconds': round(time.monotonic() - self.started, 3),
+                'phases': rounded(self.phases),
+                'tests': {t: rounded(phases) for (t, phases) in self.tests.items()}}
+
+    def write(self, path):
+        '''Write the timings as tab separated lines
+
+        The columns are test name ("*" for the whole run), phase, count,
+        seconds and bytes ("-" if not a copy).
+        '''
+        with open(path, 'w') as f:
+            f.write('*\ttotal\t1\t%.3f\t-\n' % (time.monotonic() - self.started))
+            for (test, phases) in [('*', self.phases)] + list(self.tests.items()):
+                for (name, p) in sorted(phases.items()):
+                    f.write('%s\t%s\t%i\t%.3f\t%s\n' % (
+                        test, name, p['count'], p['seconds'], p.get('bytes', '-')))
+
+
+class ExecServerError(Exception):
+    '''The exec server failed
+
+    not_run is True if the command certainly did not run, e. g. because the
+    server was gone before it got it.
+    '''
+    def __init__(self, message, not_run=False):
+        super().__init__(message)
+        self.not_run = not_run
+
+
+class ExecServer:
+    '''Long-lived command runner in the testbed
+
+    This starts lib/in-testbed/exec-server.py once through the testbed's
+    execute command and then sends it commands over that process's
+    stdin/stdout, which avoids spawning a new execute command (lxc-attach,
+    docker exec, ssh, ...) for every command.
+    '''
+    # the server's first line; before it, the execute command may print a
+    # motd or the output of shell profiles
+    HANDSHAKE = b'autopkgtest-exec-server ready\n'
+    HANDSHAKE_MAX_LINES = 100
+    # exec-server.py sends at most 64 KiB of output per frame
+    MAX_FRAME = 65536
+
+    def __init__(self, proc):
+        '''Use start() to create an ExecServer'''
+
+        self.proc = proc
+
+    @classmethod
+    def start(klass, exec_cmd):
+        '''Start the exec server in the testbed
+
+        Return None if the testbed cannot run it.
+        '''
+        with open(os.path.join(PKGDATADIR, 'lib', 'in-testbed', 'exec-server.py'),
+                  encoding='UTF-8') as f:
+            source = f.read()
+        proc = subprocess.Popen(
+            exec_cmd + ['sh', '-c',
+                        'if command -v python3 >/dev/null; then exec python3 -c "$1"; fi; '
+                        'echo exec-server-unavailable', 'sh', source],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        server = klass(proc)
+        if server._read_handshake():
+            adtlog.debug('started exec server in testbed')
+            return server
+        adtlog.debug('cannot start exec server in testbed, running commands separately')
+        server.stop()
+        return None
+
+    def stop(self):
+        '''Stop the exec server'''
+
+        try:
+            self.proc.stdin.close()
+        except (IOError, OSError):
+            pass
+        self.proc.stdout.close()
+        try:
+            self.proc.wait(timeout=timeouts['short'])
+        except subprocess.TimeoutExpired:
+            killtree(self.proc.pid)
+            self.proc.wait()
+
+    def _read_handshake(self):
+        '''Skip the execute command's own output until our handshake
+
+        Return False if it does not come.
+        '''
+        for _ in range(self.HANDSHAKE_MAX_LINES):
+            line = self.proc.stdout.readline(4096)
+            if not line:
+                return False
+            if line == self.HANDSHAKE:
+                return True
+            adtlog.debug('exec server: ignoring output %r' % line)
+        return False
+
+    def _read_frame(self):
+        header = self.proc.stdout.read(5)
+        if len(header) < 5:
+            return (None, None)
+        (kind, length) = struct.unpack('>cI', header)
+        if kind not in (b's', b'1', b'2', b'x') or length > self.MAX_FRAME:
+            raise ExecServerError('invalid frame header %r from exec server' % header)
+        data = self.proc.stdout.read(length)
+        if len(data) < length:
+            return (None, None)
+        return (kind, data)
+
+    def run(self, argv, stdout=None, stderr=None):
+        '''Run argv in the testbed
+
+        stdout and stderr are None to pass the command's output through, or
+        subprocess.PIPE to capture it.
+
+        Return (exit code, stdout, stderr) like subprocess.communicate().
+        Raise ExecServerError if the exec server failed; unless its not_run is
+        True, the command may or may not have run.
+        '''
+        captured = {b'1': [], b'2': []}
+        passthrough = {b'1': None, b'2': None}
+        if stdout is None:
+            sys.stdout.flush()
+            passthrough[b'1'] = sys.stdout.fileno()
+        if stderr is None:
+            sys.stderr.flush()
+            passthrough[b'2'] = sys.stderr.fileno()
+
+        try:
+            self.proc.stdin.write(json.dumps(argv).encode('UTF-8') + b'\n')
+            self.proc.stdin.flush()
+        except (IOError, OSError) as e:
+            raise ExecServerError('cannot send command to exec server: %s' % e,
+                                  not_run=True)
+
+        started = False
+        while True:
+            (kind, data) = self._read_frame()
+            if kind is None:
+                # the server announces the command before starting it
+                raise ExecServerError('unexpected eof from exec server',
+                                      not_run=not started)
+            if kind == b's':
+                started = True
+                continue
+            if kind == b'x':
+                break
+            fd = passthrough[kind]
+            if fd is None:
+                captured[kind].append(data)
+            else:
+                while data:
+                    data = data[os.write(fd, data):]
+
+        out = err = None
+        if stdout is not None:
+            out = b''.join(captured[b'1'])
+        if stderr is not None:
+            err = b''.join(captured[b'2'])
+        return (int(data), out, err)
+
+
 class Path:
     '''Represent a file/dir with a host and a testbed path'''
 
@@ -1399,29 +1967,31 @@ class Path:
         If check_existing is True, don't copy if the testbed path already
         exists.
         '''
-        if check_existing and self.testbed.execute(['test', '-e', self.tb])[0] == 0:
-            adtlog.debug('copydown: tb path %s already exists' % self.tb)
-            return
+        with self.testbed.timings.phase('copydown') as timing:
+            if check_existing and self.testbed.execute(['test', '-e', self.tb])[0] == 0:
+                adtlog.debug('copydown: tb path %s already exists' % self.tb)
+                return
 
-        # create directory on testbed
-        self.testbed.check_exec(['mkdir', '-p', os.path.dirname(self.tb)])
+            # create directory on testbed
+            self.testbed.check_exec(['mkdir', '-p', os.path.dirname(self.tb)])
 
-        if os.path.isdir(self.host):
-            # directories need explicit '/' appended for VirtSubproc
-            self.testbed.command('copydown', (self.host + '/', self.tb + '/'))
-        else:
-            self.testbed.command('copydown', (self.host, self.tb))
-
-        # we usually want our files be readable for the non-root user
-        if mode:
-            self.testbed.check_exec(['chmod', '-R', mode, '--', self.tb])
-        elif self.testbed.user:
-            rc = self.testbed.execute(['chown', '-R', self.testbed.user, '--', self.tb],
-                                      stderr=subprocess.PIPE)[0]
-            if rc != 0:
-                # chowning doesn't work on all shared downtmps, try to chmod
-                # instead
-                self.testbed.check_exec(['chmod', '-R', 'go+rwX', '--', self.tb])
+            if os.path.isdir(self.host):
+                # directories need explicit '/' appended for VirtSubproc
+                self.testbed.command('copydown', (self.host + '/', self.tb + '/'))
+            else:
+                self.testbed.command('copydown', (self.host, self.tb))
+            timing['bytes'] = _tree_size(self.host)
+
+            # we usually want our files be readable for the non-root user
+            if mode:
+                self.testbed.check_exec(['chmod', '-R', mode, '--', self.tb])
+            elif self.testbed.user:
+                rc = self.testbed.execute(['chown', '-R', self.testbed.user, '--', self.tb],
+                                          stderr=subprocess.PIPE)[0]
+                if rc != 0:
+                    # chowning doesn't work on all shared downtmps, try to chmod
+                    # instead
+                    self.testbed.check_exec(['chmod', '-R', 'go+rwX', '--', self.tb])
 
     def copyup(self, check_existing=False):
         '''Copy file from the testbed to the host
@@ -1434,11 +2004,31 @@ class Path:
             return
 
         os.makedirs(os.path.dirname(self.host), exist_ok=True, mode=0o2755)
+        with self.testbed.timings.phase('copyup') as timing:
+            self.testbed.command(*self._copyup_command())
+            timing['bytes'] = _tree_size(self.host)
+
+    def _copyup_command(self):
         assert self.is_dir is not None
         if self.is_dir:
-            self.testbed.command('copyup', (self.tb + '/', self.host + '/'))
+            return ('copyup', (self.tb + '/', self.host + '/'), 0)
         else:
-            self.testbed.command('copyup', (self.tb, self.host))
+            return ('copyup', (self.tb, self.host), 0)
+
+    @staticmethod
+    def copyup_many(paths):
+        '''Copy several files from the testbed to the host
+
+        This needs only one round trip to the virt server if it supports
+        batches. All paths must belong to the same testbed.
+        '''
+        for p in paths:
+            os.makedirs(os.path.dirname(p.host), exist_ok=True, mode=0o2755)
+        with paths[0].testbed.timings.phase('copyup') as timing:
+            try:
+                paths[0].testbed.command_batch([p._copyup_command() for p in paths])
+            finally:
+                timing['bytes'] = sum(_tree_size(p.host) for p in paths)
 
 
 class TempPath(Path):
@@ -1497,6 +2087,22 @@ class TempPath(Path):
 #
 
 
+def _tree_size(path):
+    '''Return the size of the files in path, which may be a directory'''
+
+    try:
+        size = os.lstat(path).st_size
+    except FileNotFoundError:
+        return 0
+    if not os.path.isdir(path) or os.path.islink(path):
+        return size
+    size = 0
+    for (root, _, files) in os.walk(path):
+        for f in files:
+            size += os.lstat(os.path.join(root, f)).st_size
+    return size
+
+
 def child_ps(pid):
     '''Get all child processes of pid'''
 
@@ -22,28 +22,58 @@
 
 import sys
 import time
-import errno
 import os
+import fcntl
+import json
+import selectors
+import struct
+import termios
+import threading
 
 summary_stream = None
 verbosity = 1  # 0: quiet (warning/error only), 1: info, 2: debug
 enable_colors = None
-
-
-def log(message, level, prefix='', timestamp=False, color=None):
-    '''Write a log message to stderr'''
-
-    if level > verbosity:
+# called by sync_output() after flushing, e. g. to wait for an OutputTee
+output_sync_hook = None
+# text file which gets all log messages and test results as JSON lines
+json_log = None
+# seconds after which buffered debug messages get written out
+flush_interval = 0.2
+
+_progname = None
+_level_names = {'ERROR': 'error', 'WARNING': 'warning', 'DBG': 'debug'}
+_lock = threading.RLock()
+_flush_pending = False
+
+
+def log(message, level, prefix='', timestamp=False, color=None, args=()):
+    '''Write a log message to stderr
+
+    If args are given, the message is formatted with them only if it is
+    actually written anywhere.
+    '''
+    if level > verbosity and json_log is None:
         return
+    if args:
+        message = message % args
+    now = time.time()
+
+    if json_log is not None:
+        log_record(time=now, level=_level_names.get(prefix, 'info'),
+                   message=message)
+        if level > verbosity:
+            return
 
     # needs lazy initialization as it may be redirected to tee
-    global enable_colors
+    global enable_colors, _progname
     if enable_colors is None:
         enable_colors = os.isatty(sys.stderr.fileno())
+    if _progname is None:
+        _progname = os.path.basename(sys.argv[0])
 
-    head = sys.argv[0].split('/')[-1]
+    head = _progname
     if timestamp:
-        head += ' [%s]: ' % time.strftime('%H:%M:%S')
+        head += ' [%s]: ' % time.strftime('%H:%M:%S', time.localtime(now))
     else:
         head += ': '
 
@@ -55,35 +85,195 @@ def log(message, level, prefix='', timestamp=False, color=None):
     if color is not None and enable_colors:
         out = b'\033[3' + chr(47 + color).encode() + b'm' + out + b'\033[0m'
 
+    with _lock:
+        _write_stderr(out)
+        # debug messages are many and only get flushed every now and then;
+        # everything else right away, together with pending debug messages
+        if level < 2:
+            _flush_stderr()
+        else:
+            _flush_later()
+
+
+def _write_stderr(data):
     # we sometimes hit EAGAIN here, try a few times
     retries = 10
-    while retries >= 0:
+    while True:
         try:
-            sys.stderr.buffer.write(out)
-            break
-        except IOError as e:
-            if e.errno == errno.EAGAIN:
-                retries -= 1
-                time.sleep(0.05)
-            else:
+            sys.stderr.buffer.write(data)
+            return
+        except BlockingIOError as e:
+            if retries <= 0:
                 raise
-    sys.stderr.buffer.flush()
-
+            # the buffer took the first part
+            data = data[e.characters_written:]
+            retries -= 1
+            time.sleep(0.05)
 
-def error(message):
-    log(message, 0, prefix='ERROR', timestamp=True, color=2)
-
-
-def warning(message):
-    log(message, 0, prefix='WARNING', color=5)
 
+def _flush_stderr():
+    retries = 10
+    while True:
+        try:
+            sys.stderr.flush()
+            return
+        except BlockingIOError:
+            if retries <= 0:
+                raise
+            retries -= 1
+            time.sleep(0.05)
 
-def info(message):
-    log(message, 1, timestamp=True, color=4)
 
+def _flush_later():
+    '''Flush stderr after flush_interval, if that is not planned already'''
 
-def debug(message):
-    log(message, 2, prefix='DBG', timestamp=False, color=8)
+    global _flush_pending
+    if _flush_pending:
+        return
+    _flush_pending = True
+
+    def flusher():
+        time.sleep(flush_interval)
+        flush()
+
+    threading.Thread(target=flusher, name='adtlog-flush', daemon=True).start()
+
+
+def flush():
+    '''Write out buffered log messages'''
+
+    global _flush_pending
+    with _lock:
+        _flush_pending = False
+        _flush_stderr()
+        if json_log is not None:
+            json_log.flush()
+
+
+def log_record(**record):
+    '''Write a record to the JSON log, if there is one
+
+    Non-ASCII characters get escaped, as messages can contain undecodable
+    bytes (as surrogate escapes) which cannot be written as UTF-8.
+    '''
+    if json_log is not None:
+        with _lock:
+            json_log.write(json.dumps(record) + '\n')
+
+
+def sync_output():
+    '''Make sure that everything written to stdout/stderr so far is out
+
+    This keeps output from the testbed, stdout and stderr in order in logs.
+    '''
+    sys.stdout.flush()
+    flush()
+    if output_sync_hook is not None:
+        output_sync_hook()
+
+
+def pipe_pending(fd):
+    '''Return the number of bytes in the pipe fd which are not read yet'''
+
+    buf = fcntl.ioctl(fd, termios.FIONREAD, b'\0\0\0\0')
+    return struct.unpack('i', buf)[0]
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class OutputTee:
+    '''Copy everything written to stdout and stderr into a log file
+
+    File descriptors 1 and 2 are replaced with pipes, so that this also
+    catches the output of child processes. A thread copies the data from
+    these pipes to the original stdout/stderr and the log file, one chunk at
+    a time in the order in which it arrives. The writers block on the (size
+    limited) pipes while the thread is behind.
+    '''
+    chunk_size = 65536
+
+    def __init__(self, logfile):
+        self.log = open(logfile, 'wb', buffering=0)
+        # pipe read end -> original fd
+        self.outputs = {}
+        for fd in (sys.stdout.fileno(), sys.stderr.fileno()):
+            (r, w) = os.pipe()
+            self.outputs[r] = os.dup(fd)
+            os.dup2(w, fd)
+            os.close(w)
+        # held while a chunk is read and written out, notified afterwards
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._copy, name='OutputTee',
+                                       daemon=True)
+        self.thread.start()
+
+    def _copy(self):
+        sel = selectors.DefaultSelector()
+        for r in self.outputs:
+            sel.register(r, selectors.EVENT_READ)
+        while sel.get_map():
+            for (key, _) in sel.select():
+                with self.cond:
+                    data = os.read(key.fd, self.chunk_size)
+                    if data:
+                        self.log.write(data)
+                        try:
+                            write_all(self.outputs[key.fd], data)
+                        except OSError:
+                            # keep logging if the terminal went away
+                            pass
+                    else:
+                        sel.unregister(key.fd)
+                    self.cond.notify_all()
+        sel.close()
+
+    def sync(self, timeout=5):
+        '''Wait until everything written so far is in the log file'''
+
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.thread.is_alive() and any(pipe_pending(r) for r in self.outputs):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+    def close(self, timeout=5):
+        '''Restore stdout/stderr and finish the log file
+
+        Output from child processes which still have the pipes open after
+        timeout seconds is not logged.
+        '''
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for (fd, orig) in zip((sys.stdout.fileno(), sys.stderr.fileno()),
+                              self.outputs.values()):
+            os.dup2(orig, fd)
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            for (r, orig) in self.outputs.items():
+                os.close(r)
+                os.close(orig)
+            self.log.close()
+
+
+def error(message, *args):
+    log(message, 0, prefix='ERROR', timestamp=True, color=2, args=args)
+
+
+def warning(message, *args):
+    log(message, 0, prefix='WARNING', color=5, args=args)
+
+
+def info(message, *args):
+    log(message, 1, timestamp=True, color=4, args=args)
+
+
+def debug(message, *args):
+    log(message, 2, prefix='DBG', timestamp=False, color=8, args=args)
 
 
 def psummary(m):
@@ -100,6 +290,7 @@ def preport(m):
 
 
 def report(tname, result):
+    log_record(time=time.time(), level='result', test=tname, result=result)
     preport('%-20s %s' % (tname, result))
 
 
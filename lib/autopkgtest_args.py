@@ -200,6 +200,9 @@ for details.'''
     g_log.add_argument('--summary-file', dest='summary',
                        help='Write a summary report to SUMMARY, emptying it '
                        'beforehand')
+    g_log.add_argument('--log-json', metavar='FILE',
+                       help='Write all log messages (including debug '
+                       'messages) and test results to FILE as JSON lines')
     g_log.add_argument('-q', '--quiet', action='store_const', dest='verbosity',
                        const=0, default=1,
                        help='Suppress all messages from %(prog)s itself '
@@ -273,6 +276,40 @@ for details.'''
                          action='append', default=[],
                          help='Copy file or dir from host into testbed after '
                          'opening')
+    g_setup.add_argument('--apt-cache', metavar='DIR',
+                         help='Run a caching proxy for apt on the host, which '
+                         'keeps downloaded packages in DIR across testbed '
+                         'resets and autopkgtest runs, and configure the '
+                         'testbed to use it')
+    g_setup.add_argument('--apt-cache-size', metavar='MiB', type=int,
+                         default=4096,
+                         help='Remove the least recently used packages from '
+                         'the --apt-cache directory when it gets larger than '
+                         'this (default: %(default)s)')
+    g_setup.add_argument('--apt-cache-listen', metavar='ADDRESS',
+                         default='127.0.0.1',
+                         help='Host address on which the --apt-cache proxy '
+                         'listens (default: %(default)s)')
+    g_setup.add_argument('--apt-cache-address', metavar='ADDRESS',
+                         help='Address under which the testbed reaches the '
+                         '--apt-cache proxy, e. g. 10.0.2.2 for QEMU '
+                         '(default: the --apt-cache-listen address)')
+    g_setup.add_argument('--apt-cache-upstream', metavar='URL',
+                         help='Fetch all packages and indexes for the '
+                         '--apt-cache proxy from this archive mirror (http://, '
+                         'https:// or file:// URL) instead of the hosts that '
+                         'the testbed asks for')
+    g_setup.add_argument('--snapshot-cache', metavar='DIR',
+                         help='Save a snapshot of the testbed into DIR after '
+                         'installing test dependencies, and revert to it '
+                         'instead of installing the same dependencies again '
+                         'in later tests and runs (needs a virt server with '
+                         'the "snapshot" capability)')
+    g_setup.add_argument('--snapshot-cache-size', metavar='MiB', type=int,
+                         default=16384,
+                         help='Remove the least recently used snapshots from '
+                         'the --snapshot-cache directory when it gets larger '
+                         'than this (default: %(default)s)')
     g_setup.add_argument('--env', metavar='VAR=value',
                          action='append', default=[],
                          help='Set arbitrary environment variable for builds and test')
@@ -324,6 +361,11 @@ for details.'''
         '--no-auto-control', dest='auto_control', action='store_false',
         default=True,
         help='Disable automatic test generation with autodep8')
+    g_misc.add_argument(
+        '--autodep8-cache', metavar='DIR',
+        help='Keep the tests that autodep8 generates for a source package in '
+        'DIR, and reuse them for the same source instead of running autodep8 '
+        'again')
     g_misc.add_argument('--build-parallel', metavar='N',
                         help='Set "parallel=N" DEB_BUILD_OPTION for building '
                         'packages (default: number of available processors)')
@@ -339,6 +381,26 @@ for details.'''
     g_misc.add_argument(
         '-V', '--validate', action='store_true', default=False,
         help='validate the test control file and exit')
+    g_misc.add_argument(
+        '--parallel-testbeds', metavar='N', type=int, default=1,
+        help='Start N testbeds and distribute the tests among them, to run '
+        'them in parallel (default: 1)')
+    g_misc.add_argument(
+        '--copy-compression', choices=['auto', 'none', 'zstd', 'lz4'],
+        default='auto',
+        help='Compress directories which are copied to and from the testbed '
+        'with this program. "auto" uses zstd or lz4 if they are available on '
+        'both ends (default: auto)')
+    g_misc.add_argument(
+        '--copy-streams', metavar='N', type=int, default=1,
+        help='Copy large directories to and from the testbed in N parallel '
+        'streams (default: 1)')
+    # internal: run the I-th of N shares of the tests for --parallel-testbeds
+    g_misc.add_argument('--parallel-worker', metavar='I/N',
+                        help=argparse.SUPPRESS)
+    # internal: where the first worker shares the prepared packages
+    g_misc.add_argument('--parallel-build-dir', metavar='DIR',
+                        help=argparse.SUPPRESS)
     g_misc.add_argument(
         '-h', '--help', action='help', default=argparse.SUPPRESS,
         help='show this help message and exit')
@@ -369,6 +431,8 @@ for details.'''
 
     # parse autopkgtest options
     args = parser.parse_args(arglist)
+    # keep the expanded options, so that --parallel-testbeds can pass them on
+    args.arglist = arglist
     adtlog.verbosity = args.verbosity
     adtlog.debug('autopkgtest options: %s' % args)
     adtlog.debug('virt-runner arguments: %s' % virt_args)
@@ -390,6 +454,29 @@ for details.'''
     if args.set_lang:
         args.env.append('LANG=' + args.set_lang)
 
+    if args.apt_cache_size < 1:
+        parser.error('--apt-cache-size must be at least 1')
+    if args.snapshot_cache_size < 1:
+        parser.error('--snapshot-cache-size must be at least 1')
+    if args.apt_cache_address is None:
+        args.apt_cache_address = args.apt_cache_listen
+
+    if args.parallel_testbeds < 1:
+        parser.error('--parallel-testbeds must be at least 1')
+    if args.parallel_testbeds > 1 and (args.shell or args.shell_fail):
+        parser.error('--parallel-testbeds cannot be used with --shell or --shell-fail')
+    if args.copy_streams < 1:
+        parser.error('--copy-streams must be at least 1')
+    if args.parallel_worker:
+        try:
+            (index, count) = map(int, args.parallel_worker.split('/'))
+            assert 0 <= index < count
+        except (ValueError, AssertionError):
+            parser.error('invalid --parallel-worker %s' % args.parallel_worker)
+        args.parallel_worker = (index, count)
+    if args.parallel_build_dir and not args.parallel_worker:
+        parser.error('--parallel-build-dir needs --parallel-worker')
+
     # set (possibly adjusted) timeout defaults
     for k in adt_testbed.timeouts:
         v = getattr(args, 'timeout_' + k)
@@ -400,6 +487,8 @@ for details.'''
 
     # this timeout is for the virt server, so pass it down via environment
     os.environ['AUTOPKGTEST_VIRT_COPY_TIMEOUT'] = str(adt_testbed.timeouts['copy'])
+    os.environ['AUTOPKGTEST_VIRT_COPY_COMPRESSION'] = args.copy_compression
+    os.environ['AUTOPKGTEST_VIRT_COPY_STREAMS'] = str(args.copy_streams)
 
     # if we have --setup-commands and it points to a file, read its contents
     for i, c in enumerate(args.setup_commands):
@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+# exec-server.py is part of autopkgtest
+# autopkgtest is a tool for testing Debian binary packages
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# See the file CREDITS for a full list of credits information (often
+# installed as /usr/share/doc/autopkgtest/CREDITS).
+#
+# Run commands in the testbed on behalf of autopkgtest, which starts this
+# once through the virt server's execute command instead of starting a new
+# execute command for each command that it runs.
+#
+# At startup, this writes the line "autopkgtest-exec-server ready" to stdout;
+# anything before that (motd, output of shell profiles) is not from us.
+# Requests are read from stdin, one JSON-encoded argv list per line.
+# Each command's stdin is /dev/null; its output is sent to stdout as
+# frames of a one byte type, a 4 byte big-endian length, and data:
+# an empty type "s" right before starting the command, type "1" for stdout
+# and "2" for stderr data, and type "x" with the decimal exit status
+# (128 + signal number if it was killed) at the end.
+#
+# Like the lxc execute command, this kills background processes that a
+# command leaks and which still hold its stdout or stderr after it exits.
+#
+# When stdin is closed, the running command (if any) is killed and this
+# exits.
+#
+# This runs with any python3 that the testbed may have, so keep it
+# compatible with old versions.
+
+import errno
+import json
+import os
+import select
+import signal
+import struct
+import subprocess
+import sys
+
+
+out = sys.stdout.buffer
+
+
+def send(kind, data):
+    out.write(struct.pack('>cI', kind, len(data)) + data)
+    out.flush()
+
+
+def pipe_holders(fds):
+    '''Return pids other than ours which hold the other end of our pipes'''
+
+    pipes = set(os.readlink('/proc/self/fd/%i' % fd) for fd in fds)
+    pids = set()
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or int(pid) == os.getpid():
+            continue
+        try:
+            for fd in os.listdir('/proc/%s/fd' % pid):
+                if os.readlink('/proc/%s/fd/%s' % (pid, fd)) in pipes:
+                    pids.add(int(pid))
+                    break
+        except OSError:
+            # process went away, or is not ours
+            continue
+    return pids
+
+
+def relay(proc):
+    '''Forward proc's output until it exits and its pipes are closed
+
+    Return False if our stdin got closed in the meantime.
+    '''
+    streams = {proc.stdout.fileno(): b'1', proc.stderr.fileno(): b'2'}
+    leaks_killed = False
+    while streams:
+        # once the command exited, don't wait for output any more
+        if proc.poll() is not None and not leaks_killed:
+            timeout = 0
+        else:
+            timeout = None
+        (ready, _, _) = select.select([0, sigchld_r] + list(streams), [], [],
+                                      timeout)
+
+        if not ready:
+            # everything the command wrote is forwarded, but something
+            # it left behind still holds the pipes open
+            for pid in pipe_holders(streams):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            leaks_killed = True
+            continue
+
+        if 0 in ready:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            return False
+
+        for fd in ready:
+            if fd == sigchld_r:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except BlockingIOError:
+                    pass
+                continue
+            data = os.read(fd, 65536)
+            if data:
+                send(streams[fd], data)
+            else:
+                del streams[fd]
+
+    return True
+
+
+def run(argv):
+    # without this, autopkgtest cannot know whether the command ran if we
+    # die before sending anything else
+    send(b's', b'')
+    try:
+        proc = subprocess.Popen(argv, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                preexec_fn=os.setpgrp)
+    except OSError as e:
+        send(b'2', ('%s: %s\n' % (argv[0], e.strerror)).encode())
+        return e.errno == errno.ENOENT and 127 or 126
+
+    if not relay(proc):
+        sys.exit(0)
+    proc.stdout.close()
+    proc.stderr.close()
+    rc = proc.wait()
+    if rc < 0:
+        rc = 128 - rc
+    return rc
+
+
+def main():
+    global sigchld_r
+
+    # wake up select() when a command exits
+    (sigchld_r, sigchld_w) = os.pipe()
+    os.set_blocking(sigchld_r, False)
+    os.set_blocking(sigchld_w, False)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
+    signal.set_wakeup_fd(sigchld_w)
+
+    buf = b''
+    out.write(b'autopkgtest-exec-server ready\n')
+    out.flush()
+    while True:
+        while b'\n' not in buf:
+            block = os.read(0, 65536)
+            if not block:
+                return
+            buf += block
+        (line, buf) = buf.split(b'\n', 1)
+        rc = run(json.loads(line.decode('UTF-8')))
+        send(b'x', str(rc).encode())
+
+
+main()
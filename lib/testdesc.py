@@ -23,16 +23,18 @@
 import string
 import re
 import errno
+import hashlib
 import os.path
+import shutil
 import subprocess
 import tempfile
-from typing import (Dict, FrozenSet, Iterable, List, Optional, Union)
+from typing import (Dict, FrozenSet, Iterable, List, Optional, Tuple, Union)
 
-import debian.deb822
 import debian.debian_support
 import debian.debfile
 
 import adtlog
+import adt_deps
 
 #
 # Abstract test representation
@@ -236,10 +238,21 @@ class Test:
 #
 
 
+_field_re = re.compile(r'^(?P<key>[^: \t\n\r\f\v]+)\s*:\s*(?P<data>(?:\S+(\s+\S+)*)?)\s*$')
+_gpg_re = re.compile(r'^-----(?P<action>BEGIN|END) PGP (?P<what>[^-]+)-----[\r\t ]*$')
+# field names as they appear in the file -> the string.capwords() key we use
+_field_names = {}   # type: Dict[str, str]
+
+
 def parse_rfc822(path):
     '''Parse Debian-style RFC822 file
 
     Yield dictionaries with the keys/values.
+
+    This reads the file in a single pass and behaves like
+    debian.deb822.Deb822.iter_paragraphs(), including the handling of
+    OpenPGP signed files (.dsc, .changes), but additionally drops comments.
+    A field's continuation lines are only joined when the field ends.
     '''
     try:
         f = open(path, encoding='UTF-8')
@@ -248,31 +261,87 @@ def parse_rfc822(path):
             raise
         return
 
-    # filter out comments, python-debian doesn't do that
-    # (http://bugs.debian.org/743174)
-    lines = []
-    for line in f:
-        # completely ignore ^# as that breaks continuation lines
-        if line.startswith('#'):
-            continue
-        # filter out comments which don't start on first column (Debian
-        # #743174); entirely remove line if all that's left is whitespace, as
-        # that again breaks continuation lines
-        if '#' in line:
-            line = line.split('#', 1)[0]
-            if not line.strip():
+    with f:
+        record = {}     # type: Dict[str, str]
+        key = None      # type: Optional[str]
+        value = []      # type: List[str]
+        started = False     # seen a non-blank line in this paragraph
+        have_lines = False  # seen a line which is not OpenPGP armor
+        signed = False
+        state = 'SAFE'
+
+        for line in f:
+            # completely ignore ^# as that breaks continuation lines
+            if line.startswith('#'):
                 continue
-        lines.append(line)
-    f.close()
+            # filter out comments which don't start on first column (Debian
+            # #743174); entirely remove line if all that's left is
+            # whitespace, as that again breaks continuation lines
+            if '#' in line:
+                line = line.split('#', 1)[0]
+                if not line.strip():
+                    continue
+            line = line.strip('\r\n')
+            blank = not line.strip(' \t\n\r\v\f')
+            if not started:
+                if blank:
+                    continue
+                started = True
+
+            m = _gpg_re.match(line) if line.startswith('-') else None
+            if m is None:
+                if state == 'SAFE':
+                    if not blank:
+                        have_lines = True
+                        fm = None if line[0] in ' \t' else _field_re.match(line)
+                        if fm is None:
+                            # continuation line; these get un-escaped by
+                            # joining them without the line breaks
+                            if (key is not None and line[0].isspace() and
+                                    not line.isspace()):
+                                value.append(line)
+                            continue
+                        if key is not None:
+                            record[key] = ''.join(value).replace('  ', ' ')
+                        key = _field_names.get(fm.group('key'))
+                        if key is None:
+                            key = string.capwords(fm.group('key'))
+                            _field_names[fm.group('key')] = key
+                        value = [fm.group('data')]
+                        continue
+                    if signed:
+                        # blank lines do not separate paragraphs in signed files
+                        continue
+                elif state == 'SIGNED MESSAGE':
+                    if blank:
+                        state = 'SAFE'
+                    else:
+                        signed = True
+                    continue
+                else:
+                    continue
+            else:
+                if m.group('action') == 'BEGIN':
+                    state = m.group('what')
+                    if not have_lines:
+                        signed = True
+                    continue
 
-    for p in debian.deb822.Deb822.iter_paragraphs(lines):
-        r = {}
-        for field, value in p.items():
-            # un-escape continuation lines
-            v = ''.join(value.split('\n')).replace('  ', ' ')
-            field = string.capwords(field)
-            r[field] = v
-        yield r
+            # end of paragraph
+            if key is not None:
+                record[key] = ''.join(value).replace('  ', ' ')
+            if not record:
+                return
+            yield record
+            record = {}
+            key = None
+            started = have_lines = signed = False
+            state = 'SAFE'
+
+        if key is not None:
+            record[key] = ''.join(value).replace('  ', ' ')
+        if record:
+            yield record
 
 
 def _debian_check_unknown_fields(name, record):
@@ -283,11 +352,59 @@ def _debian_check_unknown_fields(name, record):
         raise Unsupported(name, 'unknown field %s' % unknown_keys.pop())
 
 
-def _debian_packages_from_source(srcdir):
+class _DebianControl:
+    '''debian/control of a source package
+
+    This is parsed only once, and what the tests' Depends: expand to is
+    computed on first use and then reused for all tests of the package.
+    '''
+
+    def __init__(self, srcdir, testbed_arch):
+        self.path = os.path.join(srcdir, 'debian/control')
+        self.testbed_arch = testbed_arch
+        self._stanzas = None    # type: Optional[List[Dict[str, str]]]
+        self._packages = None   # type: Optional[Tuple[List[str], List[str]]]
+        self._synth_packages = None     # type: Optional[List[Tuple[str, Optional[str]]]]
+        self._build_deps = None     # type: Optional[List[str]]
+        self._recommends = None     # type: Optional[List[str]]
+
+    @property
+    def stanzas(self):
+        if self._stanzas is None:
+            self._stanzas = list(parse_rfc822(self.path))
+        return self._stanzas
+
+    def packages(self):
+        '''Return (binary packages with arch restrictions, package names)'''
+
+        if self._packages is None:
+            self._packages = _debian_packages_from_source(self)
+        return self._packages
+
+    def synth_packages(self):
+        '''Return [(binary package, synthesized dependency or None)] for @'''
+
+        if self._synth_packages is None:
+            self._synth_packages = [(d, _synthesize_deps(d, self.testbed_arch))
+                                    for d in self.packages()[0]]
+        return self._synth_packages
+
+    def build_deps(self):
+        if self._build_deps is None:
+            self._build_deps = _debian_build_deps_from_source(self)
+        return self._build_deps
+
+    def recommends(self):
+        if self._recommends is None:
+            self._recommends = _debian_recommends_from_source(self)
+        return self._recommends
+
+
+def _debian_packages_from_source(control):
     packages = []
     packages_no_arch = []
 
-    for st in parse_rfc822(os.path.join(srcdir, 'debian/control')):
+    for st in control.stanzas:
         if 'Package' not in st:
             # source stanza
             continue
@@ -315,9 +432,9 @@ def _filter_variables(deps):
     return ', '.join(deplist)
 
 
-def _debian_recommends_from_source(srcdir, testbed_arch):
+def _debian_recommends_from_source(control):
     deps = ''
-    for st in parse_rfc822(os.path.join(srcdir, 'debian/control')):
+    for st in control.stanzas:
         if 'Recommends' in st:
             deps += st['Recommends'] + ','
 
@@ -327,16 +444,11 @@ def _debian_recommends_from_source(srcdir, testbed_arch):
     deps = _filter_variables(deps)
 
     # resolve arch specific dependencies and build profiles
-    perl = subprocess.Popen(['perl', '-'], stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE)
-    code = '''use Dpkg::Deps;
-              $dep = deps_parse('%s', reduce_restrictions => 1,
-                                host_arch => '%s');
-              $out = $dep->output();
-              print $out, "\\n";
-              ''' % (deps, testbed_arch)
-    deps = perl.communicate(code.encode('UTF-8'))[0].decode('UTF-8').strip()
-    if perl.returncode != 0:
+    try:
+        deps = adt_deps.reduce_deps(deps, control.testbed_arch,
+                                    reduce_restrictions=True)
+    except ValueError as e:
+        adtlog.debug(str(e))
         raise InvalidControl('source', 'Invalid Recommends')
 
     deps = [d.strip() for d in deps.split(',')]
@@ -350,9 +462,9 @@ def _debian_recommends_from_source(srcdir, testbed_arch):
     return deps
 
 
-def _debian_build_deps_from_source(srcdir, testbed_arch):
+def _debian_build_deps_from_source(control):
     deps = ''
-    for st in parse_rfc822(os.path.join(srcdir, 'debian/control')):
+    for st in control.stanzas:
         if 'Build-depends' in st:
             deps += st['Build-depends']
         if 'Build-depends-indep' in st:
@@ -361,20 +473,11 @@ def _debian_build_deps_from_source(srcdir, testbed_arch):
             deps += ', ' + st['Build-depends-arch']
 
     # resolve arch specific dependencies and build profiles
-    perl = subprocess.Popen(['perl', '-'], stdin=subprocess.PIPE,
-                            stdout=subprocess.PIPE)
-    code = '''use Dpkg::Deps;
-              $supports_profiles = ($Dpkg::Deps::VERSION gt '1.04');
-              $dep = deps_parse('%s', reduce_arch => 1,
-                                reduce_profiles => $supports_profiles,
-                                build_dep => 1, host_arch => '%s');
-              $out = $dep->output();
-              # fall back to ignoring build profiles
-              $out =~ s/ <[^ >]+>//g if (!$supports_profiles);
-              print $out, "\\n";
-              ''' % (deps, testbed_arch)
-    deps = perl.communicate(code.encode('UTF-8'))[0].decode('UTF-8').strip()
-    if perl.returncode != 0:
+    try:
+        deps = adt_deps.reduce_deps(deps, control.testbed_arch, reduce_arch=True,
+                                    reduce_profiles=True, build_dep=True)
+    except ValueError as e:
+        adtlog.debug(str(e))
         raise InvalidControl('source', 'Invalid build dependencies')
 
     deps = [d.strip() for d in deps.split(',')]
@@ -424,36 +527,32 @@ def _synthesize_deps(dep, testbed_arch):
     dep = dep.strip()
     m = dep_re.match(dep)
 
-    arch_matches = 'y'
     if m.group('arch') is not None:
-        arch_matches = False
-        perl = subprocess.Popen(['perl', '-'], stdin=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
-        code = '''use Dpkg::Deps;
-                  print deps_parse('foo [%s]')->arch_is_concerned('%s') ? 'y' : 'n';
-                  ''' % (m.group('arch'), testbed_arch)
-        arch_matches = perl.communicate(code.encode('UTF-8'))[0].decode('UTF-8').strip()
-        if perl.returncode != 0:
+        try:
+            arches = adt_deps.parse_simple('foo [%s]' % m.group('arch')).arches
+        except ValueError as e:
+            adtlog.debug(str(e))
             raise InvalidControl('source', 'Invalid (Test-)Depends architecture qualifiers')
+        if not adt_deps.debarch_is_concerned(testbed_arch, arches):
+            return None
 
-    if arch_matches == 'y':
-        return m.group('package')
-    else:
-        return None
+    return m.group('package')
 
 
-def _parse_debian_depends(testname, dep_str, srcdir, testbed_arch):
+def _parse_debian_depends(testname, dep_str, control):
     '''Parse Depends: line in a Debian package
 
     Split dependencies (comma separated), validate their syntax, and expand @,
-    @builddeps@ and @recommends@. Return a list of dependencies.
+    @builddeps@ and @recommends@ from the _DebianControl. Return a list of
+    dependencies.
 
     This may raise an InvalidControl exception if there are invalid
     dependencies.
     '''
     deps = []
     synthdeps = []
-    (my_packages, my_packages_no_arch) = _debian_packages_from_source(srcdir)
+    testbed_arch = control.testbed_arch
+    my_packages_no_arch = control.packages()[1]
     for alt_group_str in dep_str.split(','):
         alt_group_str = alt_group_str.strip()
         if not alt_group_str:
@@ -461,18 +560,17 @@ def _parse_debian_depends(testname, dep_str, srcdir, testbed_arch):
             continue
         adtlog.debug('processing dependency %s' % alt_group_str)
         if alt_group_str == '@':
-            for d in my_packages:
+            for (d, s) in control.synth_packages():
                 adtlog.debug('synthesised dependency %s' % d)
                 deps.append(d)
-                s = _synthesize_deps(d, testbed_arch)
                 if s:
                     synthdeps.append(s)
         elif alt_group_str == '@builddeps@':
-            for d in _debian_build_deps_from_source(srcdir, testbed_arch):
+            for d in control.build_deps():
                 adtlog.debug('synthesised dependency %s' % d)
                 deps.append(d)
         elif alt_group_str == '@recommends@':
-            for d in _debian_recommends_from_source(srcdir, testbed_arch):
+            for d in control.recommends():
                 adtlog.debug('synthesised dependency %s' % d)
                 deps.append(d)
         else:
@@ -496,8 +594,109 @@ def _parse_debian_depends(testname, dep_str, srcdir, testbed_arch):
     return (deps, synthdeps)
 
 
-def _autodep8(srcdir):
-    '''Generate control file with autodep8'''
+# maximum number of entries in the autodep8 cache directory
+autodep8_cache_entries = 1000
+
+
+def _autodep8_cache_key(srcdir):
+    '''Return the autodep8 cache key for srcdir, or None
+
+    This covers the source name and version, debian/control, everything in
+    debian/tests/, and the installed autodep8 itself.
+    '''
+    autodep8 = shutil.which('autodep8')
+    if autodep8 is None:
+        return None
+    st = os.stat(autodep8)
+
+    h = hashlib.sha256()
+    h.update(('%s %i %i\n' % (os.path.realpath(autodep8), st.st_size,
+                              st.st_mtime_ns)).encode())
+    try:
+        with open(os.path.join(srcdir, 'debian', 'changelog'), 'rb') as f:
+            m = re.match(rb'(\S+) \(([^()\s]+)\)', f.readline())
+        if m:
+            h.update(b'%s %s\n' % m.groups())
+    except FileNotFoundError:
+        pass
+
+    paths = [os.path.join(srcdir, 'debian', 'control')]
+    for (root, dirs, files) in os.walk(os.path.join(srcdir, 'debian', 'tests')):
+        dirs.sort()
+        paths += [os.path.join(root, f) for f in sorted(files)]
+    for path in paths:
+        h.update(b'\0' + os.path.relpath(path, srcdir).encode() + b'\0')
+        try:
+            with open(path, 'rb') as f:
+                h.update(hashlib.sha256(f.read()).digest())
+        except (FileNotFoundError, IsADirectoryError):
+            pass
+    return h.hexdigest()
+
+
+def _autodep8_cache_lookup(cache_dir, key):
+    '''Return (found, control text or None) from the autodep8 cache'''
+
+    for (name, ok) in [(key, True), (key + '.failed', False)]:
+        path = os.path.join(cache_dir, name)
+        try:
+            with open(path, 'rb') as f:
+                ctrl = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            continue
+        return (True, ctrl if ok else None)
+    return (False, None)
+
+
+def _autodep8_cache_store(cache_dir, key, ctrl):
+    '''Put the autodep8 output ctrl (None if it failed) into the cache'''
+
+    name = key if ctrl is not None else key + '.failed'
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        (fd, tmp) = tempfile.mkstemp(prefix='.', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(ctrl or b'')
+        os.rename(tmp, os.path.join(cache_dir, name))
+
+        entries = []
+        for entry in os.scandir(cache_dir):
+            if not entry.name.startswith('.'):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort()
+        for (_, path) in entries[:-autodep8_cache_entries]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+    except OSError as e:
+        adtlog.warning('cannot write to autodep8 cache %s: %s' % (cache_dir, e))
+
+
+def _autodep8(srcdir, cache_dir=None):
+    '''Generate control file with autodep8
+
+    With cache_dir, reuse the result of an earlier run on the same source.
+    '''
+    key = None
+    if cache_dir:
+        key = _autodep8_cache_key(srcdir)
+    if key is not None:
+        (found, ctrl) = _autodep8_cache_lookup(cache_dir, key)
+        if found:
+            if ctrl is None:
+                adtlog.debug('autodep8 cache %s: failed to generate control' % key)
+                return None
+            adtlog.debug('autodep8 cache %s: generated control: -----\n%s\n-------' %
+                         (key, ctrl.decode()))
+            f = tempfile.NamedTemporaryFile(prefix='autodep8.')
+            f.write(ctrl)
+            f.flush()
+            return f
 
     f = tempfile.NamedTemporaryFile(prefix='autodep8.')
     try:
@@ -511,28 +710,22 @@ def _autodep8(srcdir):
     if autodep8.returncode == 0:
         f.flush()
         f.seek(0)
-        ctrl = f.read().decode()
-        adtlog.debug('autodep8 generated control: -----\n%s\n-------' % ctrl)
+        ctrl = f.read()
+        adtlog.debug('autodep8 generated control: -----\n%s\n-------' % ctrl.decode())
+        if key is not None:
+            _autodep8_cache_store(cache_dir, key, ctrl)
         return f
 
     f.close()
     adtlog.debug('autodep8 failed to generate control (exit status %i): %s' %
                  (autodep8.returncode, err))
+    if key is not None:
+        _autodep8_cache_store(cache_dir, key, None)
     return None
 
 
 def _matches_architecture(host_arch, arch_wildcard):
-    try:
-        subprocess.check_call(['perl', '-mDpkg::Arch', '-e',
-                               'exit(!Dpkg::Arch::debarch_is(shift, shift))',
-                               host_arch, arch_wildcard])
-    except subprocess.CalledProcessError as e:
-        # returns 1 if host_arch is not matching arch_wildcard; other
-        # errors shouldn't be ignored
-        if e.returncode != 1:
-            raise
-        return False
-    return True
+    return adt_deps.debarch_is(host_arch, arch_wildcard)
 
 
 def _check_architecture(name, testbed_arch, architectures):
@@ -583,11 +776,14 @@ def _check_architecture(name, testbed_arch, architectures):
 
 def parse_debian_source(srcdir, testbed_caps, testbed_arch, control_path=None,
                         auto_control=True, ignore_restrictions=(),
-                        only_tests=()):
+                        only_tests=(), autodep8_cache=None, unsupported=None):
     '''Parse test descriptions from a Debian DEP-8 source dir
 
     @ignore_restrictions: If we would skip the test due to these restrictions,
                           run it anyway
+    @autodep8_cache: Host directory for caching the autodep8 output
+    @unsupported: If given, a list to which the Unsupported exceptions of
+                  skipped tests get appended instead of reporting them
 
     You can specify an alternative path for the control file (default:
     srcdir/debian/tests/control).
@@ -602,6 +798,7 @@ def parse_debian_source(srcdir, testbed_caps, testbed_arch, control_path=None,
     some_skipped = False
     command_counter = 0
     tests = []
+    dcontrol = _DebianControl(srcdir, testbed_arch)
     if not control_path:
         control_path = os.path.join(srcdir, 'debian', 'tests', 'control')
         dtc_exists = os.path.exists(control_path)
@@ -610,17 +807,12 @@ def parse_debian_source(srcdir, testbed_caps, testbed_arch, control_path=None,
         if auto_control:
             if not dtc_exists:
                 try_autodep8 = True
-            else:
-                dcontrol_path = os.path.join(srcdir, 'debian', 'control')
-                for record in parse_rfc822(dcontrol_path):
-                    testsuite = record.get('Testsuite', '')
-                    if 'autopkgtest-pkg-' in testsuite:
-                        try_autodep8 = True
-                    # We only want to look at the source section
-                    break
+            # We only want to look at the source section
+            elif dcontrol.stanzas and 'autopkgtest-pkg-' in dcontrol.stanzas[0].get('Testsuite', ''):
+                try_autodep8 = True
 
         if try_autodep8:
-            control = _autodep8(srcdir)
+            control = _autodep8(srcdir, autodep8_cache)
             if control is not None:
                 control_path = control.name
             elif not dtc_exists:
@@ -669,8 +861,7 @@ def parse_debian_source(srcdir, testbed_caps, testbed_arch, control_path=None,
                 (depends, synth_depends) = _parse_debian_depends(
                     test_names[0],
                     record.get('Depends', '@'),
-                    srcdir,
-                    testbed_arch)
+                    dcontrol)
                 if 'Test-command' in record:
                     raise InvalidControl('*', 'Only one of "Tests" or '
                                          '"Test-Command" may be given')
@@ -689,7 +880,7 @@ def parse_debian_source(srcdir, testbed_caps, testbed_arch, control_path=None,
                         test.check_testbed_compat(testbed_caps, ignore_restrictions)
                     except Unsupported as u:
                         if (not only_tests) or n in only_tests:
-                            u.report()
+                            _skip(u, unsupported)
                             some_skipped = True
                     else:
                         tests.append(test)
@@ -698,8 +889,7 @@ def parse_debian_source(srcdir, testbed_caps, testbed_arch, control_path=None,
                 (depends, synth_depends) = _parse_debian_depends(
                     command,
                     record.get('Depends', '@'),
-                    srcdir,
-                    testbed_arch)
+                    dcontrol)
                 if feature_test_name is None:
                     command_counter += 1
                     name = 'command%i' % command_counter
@@ -716,7 +906,97 @@ def parse_debian_source(srcdir, testbed_caps, testbed_arch, control_path=None,
                                      ' field')
         except Unsupported as u:
             if not only_tests:
-                u.report()
+                _skip(u, unsupported)
                 some_skipped = True
 
     return (tests, some_skipped)
+
+
+def _skip(u, unsupported):
+    if unsupported is None:
+        u.report()
+    else:
+        unsupported.append(u)
+
+
+def validate_source(srcdir, testbed_caps, testbed_arch, auto_control=False,
+                    autodep8_cache=None):
+    '''Check the test descriptions of a Debian source dir
+
+    This does not need a testbed. Return a dictionary with the source
+    directory ("path"), source package name ("source"), names of the
+    runnable tests ("tests"), a list of "problems" (dictionaries with "test",
+    "kind" and "message"), and the overall "status": "ok", "no-tests",
+    "unsupported" (some tests would be skipped), "invalid" (the test control
+    file is broken) or "error" (the source could not be read or processed).
+    '''
+    result = {'path': srcdir, 'source': None, 'tests': [], 'problems': []}
+    try:
+        for record in parse_rfc822(os.path.join(srcdir, 'debian', 'control')):
+            result['source'] = record.get('Source')
+            break
+
+        unsupported = []    # type: List[Unsupported]
+        (tests, _) = parse_debian_source(
+            srcdir, testbed_caps, testbed_arch, auto_control=auto_control,
+            autodep8_cache=autodep8_cache, unsupported=unsupported)
+    except InvalidControl as e:
+        result['problems'].append({'test': e.testname, 'kind': 'invalid',
+                                   'message': e.message})
+        result['status'] = 'invalid'
+        return result
+    except (OSError, UnicodeDecodeError) as e:
+        result['problems'].append({'test': '*', 'kind': 'error',
+                                   'message': str(e)})
+        result['status'] = 'error'
+        return result
+    except Exception as e:
+        # anything else that a broken source triggers must not stop the
+        # validation of the other ones
+        result['problems'].append({'test': '*', 'kind': 'error',
+                                   'message': '%s: %s' % (type(e).__name__, e)})
+        result['status'] = 'error'
+        return result
+
+    result['tests'] = [t.name for t in tests]
+    for u in unsupported:
+        result['problems'].append({'test': u.testname, 'kind': 'unsupported',
+                                   'message': u.message})
+    if unsupported:
+        result['status'] = 'unsupported'
+    elif tests:
+        result['status'] = 'ok'
+    else:
+        result['status'] = 'no-tests'
+    return result
+
+
+def order_by_dependencies(tests: List[Test]) -> List[Test]:
+    '''Plan the order in which to run tests on a revertable testbed
+
+    Tests with identical dependencies are grouped together, so that their
+    dependencies only need to be installed once. After a group, the next one
+    is the first remaining group whose dependencies include all of the
+    current ones, as these can be installed without reverting the testbed,
+    or else just the first remaining group. Tests that break the testbed
+    come last within their group, as the testbed must be reverted after
+    them. Otherwise the order of the control file is kept.
+    '''
+    groups = {}  # type: Dict[Tuple[FrozenSet[str], FrozenSet[str]], List[Test]]
+    for t in tests:
+        key = (frozenset(t.depends), frozenset(t.synth_depends))
+        groups.setdefault(key, []).append(t)
+
+    ordered = []  # type: List[Test]
+    current = None  # type: Optional[Tuple[FrozenSet[str], FrozenSet[str]]]
+    while groups:
+        for key in groups:
+            if current is not None and key[0] >= current[0] and key[1] >= current[1]:
+                break
+        else:
+            key = next(iter(groups))
+        group = groups.pop(key)
+        ordered += [t for t in group if 'breaks-testbed' not in t.restrictions]
+        ordered += [t for t in group if 'breaks-testbed' in t.restrictions]
+        current = key
+    return ordered